@@ -0,0 +1,262 @@
+"""Pluggable geocoders used by LocationMixin.
+
+Settings to be placed in settings.py:
+    MIXINS_GEOCODER: dotted path to the geocoder class (default 'mixins.geocoding.GoogleGeocoder')
+    MIXINS_GEOCODER_API_KEY: API key passed to GoogleGeocoder
+    MIXINS_GEOCODER_GAZETTEER: path of the CSV file read by GazetteerGeocoder
+    MIXINS_GEOCODE_DEFERRED: if True, LocationMixin.save() queues geocoding instead of doing it
+        inline (default False; a model's geocodeDeferred attribute overrides it)
+    MIXINS_GEOCODER_RATE: most geocoder requests per second made by drain() (default 5)
+    MIXINS_GEOCODER_WORKERS: number of threads drain() geocodes with (default 4)
+
+A geocoder's geocode(address) returns a list of (place, (latitude, longitude)) candidates.  Results,
+including empty and ambiguous ones, are stored in GeocodedAddress keyed on the normalized address,
+so each distinct address reaches the configured geocoder once.  Delete those rows to look an
+address up again.  A geocoder that can't answer at all raises GeocoderUnavailable, and nothing is
+stored for the address.
+
+GazetteerGeocoder answers from a local CSV file of address,latitude,longitude rows and never
+touches the network, which suits tests and batch imports.
+
+Deferred saves record the instance in PendingGeocode; the drain_geocode_queue command works
+through those rows in batches, geocoding each distinct address once and writing the coordinates
+back with one UPDATE per address.
+
+haversine() and bounding_box() back the within_radius()/nearest() methods of LocationQuerySet,
+which need no GIS support from the database.
+
+GoogleGeocoder requires geopy: http://code.google.com/p/geopy/
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import simplejson
+from django.utils.importlib import import_module
+from mixins.ratelimit import RateLimiter
+from mixins.search import normalize
+import csv
+import hashlib
+import math
+import time
+import traceback
+
+EARTH_RADIUS_KM = 6371.0
+HALF_CIRCUMFERENCE_KM = math.pi * EARTH_RADIUS_KM
+
+_geocoder = None
+
+def get_geocoder():
+    """Return the configured geocoder instance."""
+    global _geocoder
+    if _geocoder is None:
+        path = getattr(settings, 'MIXINS_GEOCODER', 'mixins.geocoding.GoogleGeocoder')
+        module, name = path.rsplit('.', 1)
+        _geocoder = getattr(import_module(module), name)()
+    return _geocoder
+
+def address_key(address):
+    """Return the GeocodedAddress key of a normalized address."""
+    return hashlib.sha1(address).hexdigest()
+
+class GeocoderUnavailable(Exception):
+    """Raised by a geocoder that can't look up any address, e.g. when its library is missing."""
+    pass
+
+class GoogleGeocoder(object):
+    """Geocode through geopy's Google geocoder.  Raises GeocoderUnavailable if geopy isn't installed."""
+
+    def geocode(self, address):
+        try:
+            from geopy import geocoders
+        except ImportError:
+            raise GeocoderUnavailable('GoogleGeocoder requires geopy.')
+        g = geocoders.Google(getattr(settings, 'MIXINS_GEOCODER_API_KEY', ''))
+        return list(g.geocode(address, exactly_one=False))
+
+class GazetteerGeocoder(object):
+    """Geocode from the CSV file named by MIXINS_GEOCODER_GAZETTEER, matching normalized addresses exactly."""
+
+    def __init__(self, path=None):
+        self.places = {}
+        reader = csv.reader(open(path or settings.MIXINS_GEOCODER_GAZETTEER, 'rb'))
+        for row in reader:
+            if len(row) < 3:
+                continue
+            try:
+                point = (float(row[1]), float(row[2]))
+            except ValueError:
+                continue # header or malformed row
+            self.places.setdefault(normalize(row[0].decode('utf-8')), []).append((row[0], point))
+
+    def geocode(self, address):
+        return list(self.places.get(normalize(address), []))
+
+def cached(normalized):
+    """Return the stored candidates for a normalized address, or None if it hasn't been geocoded."""
+    from mixins.models import GeocodedAddress
+    try:
+        results = GeocodedAddress.objects.get(key=address_key(normalized)).results
+    except GeocodedAddress.DoesNotExist:
+        return None
+    return [(place, tuple(point)) for place, point in simplejson.loads(results)]
+
+def store(normalized, candidates):
+    """Store the candidates found for a normalized address and return them as (unicode, tuple) pairs."""
+    from mixins.models import GeocodedAddress
+    candidates = [(unicode(place), tuple(point)) for place, point in candidates]
+    sid = transaction.savepoint()
+    try:
+        GeocodedAddress.objects.create(key=address_key(normalized), address=normalized,
+                                       results=simplejson.dumps(candidates))
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Another save geocoded the same address first.
+        transaction.savepoint_rollback(sid)
+    return candidates
+
+def geocode(address):
+    """Return the (place, (latitude, longitude)) candidates for address, from GeocodedAddress when known.
+    
+    Returns no candidates, without storing anything, if the geocoder is unavailable.
+    """
+    normalized = normalize(address)
+    if not normalized:
+        return []
+    candidates = cached(normalized)
+    if candidates is None:
+        try:
+            candidates = store(normalized, get_geocoder().geocode(address))
+        except GeocoderUnavailable:
+            traceback.print_exc()
+            return []
+    return candidates
+
+def defer(instance):
+    """Queue a saved LocationMixin instance to be geocoded by drain()."""
+    from mixins.models import PendingGeocode
+    ct = ContentType.objects.get_for_model(instance)
+    address = instance.buildFullAddress()
+    if PendingGeocode.objects.filter(content_type=ct, object_id=instance.pk).update(address=address, attempts=0):
+        return
+    sid = transaction.savepoint()
+    try:
+        PendingGeocode.objects.create(content_type=ct, object_id=instance.pk, address=address)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        PendingGeocode.objects.filter(content_type=ct, object_id=instance.pk).update(address=address, attempts=0)
+
+def _lookup(geocoder, limiter, address, retries):
+    """Geocode address, retrying failures with backoff.  Returns None if every try failed."""
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            return list(geocoder.geocode(address))
+        except GeocoderUnavailable:
+            traceback.print_exc()
+            return None
+        except Exception:
+            if attempt == retries:
+                traceback.print_exc()
+                return None
+            time.sleep(2 ** attempt)
+
+@transaction.commit_on_success
+def _write_batch(pending, results, max_attempts):
+    """Write the coordinates found for a batch of PendingGeocode rows back and dequeue them."""
+    from mixins.models import PendingGeocode
+    updates = {}
+    failed = []
+    for row in pending:
+        candidates = results.get(normalize(row.address))
+        if candidates is None:
+            failed.append(row)
+            continue
+        point = len(candidates) == 1 and candidates[0][1] or (0, 0)
+        updates.setdefault((row.content_type_id, point), []).append(row.object_id)
+    for (ct_id, point), ids in updates.iteritems():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        model._base_manager.filter(pk__in=ids).update(latitude=point[0], longitude=point[1])
+    for row in pending:
+        # Rows whose address changed since they were read were queued again and stay.
+        rows = PendingGeocode.objects.filter(pk=row.pk, address=row.address)
+        if row in failed and row.attempts + 1 < max_attempts:
+            rows.update(attempts=F('attempts') + 1)
+        else:
+            rows.delete()
+    return len(pending) - len(failed)
+
+def drain(batch_size=100, workers=None, rate=None, retries=2, max_attempts=3):
+    """Geocode every queued PendingGeocode row, batch_size rows at a time.  Returns (geocoded, failed).
+    
+    Each batch's distinct addresses that aren't in GeocodedAddress are looked up on a pool of
+    threads sharing one rate limit.  A row whose lookup fails is kept for a later run until it
+    has failed max_attempts times.
+    """
+    from mixins.models import PendingGeocode
+    from multiprocessing.pool import ThreadPool
+    workers = workers or getattr(settings, 'MIXINS_GEOCODER_WORKERS', 4)
+    if rate is None:
+        rate = getattr(settings, 'MIXINS_GEOCODER_RATE', 5)
+    geocoder = get_geocoder()
+    limiter = RateLimiter(rate)
+    pool = ThreadPool(workers)
+    geocoded = failed = 0
+    last_id = 0
+    try:
+        while True:
+            pending = list(PendingGeocode.objects.filter(pk__gt=last_id).order_by('pk')[:batch_size])
+            if not pending:
+                break
+            last_id = pending[-1].pk
+            results = {'': []}
+            addresses = {}
+            for row in pending:
+                normalized = normalize(row.address)
+                if normalized in results or normalized in addresses:
+                    continue
+                candidates = cached(normalized)
+                if candidates is None:
+                    addresses[normalized] = row.address
+                else:
+                    results[normalized] = candidates
+            addresses = addresses.items()
+            lookups = pool.map(lambda item: _lookup(geocoder, limiter, item[1], retries), addresses)
+            for (normalized, address), candidates in zip(addresses, lookups):
+                if candidates is not None:
+                    results[normalized] = store(normalized, candidates)
+            done = _write_batch(pending, results, max_attempts)
+            geocoded += done
+            failed += len(pending) - done
+    finally:
+        pool.close()
+    return geocoded, failed
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Return the great-circle distance in km between two latitude/longitude points."""
+    lat1, lon1, lat2, lon2 = [math.radians(value) for value in (lat1, lon1, lat2, lon2)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def bounding_box(lat, lon, km):
+    """Return ((min_lat, max_lat), longitude ranges) enclosing every point within km of lat/lon.
+    
+    Longitude ranges is a list of (min_lon, max_lon), split in two where the box crosses the
+    antimeridian, or None if the box spans every longitude (the circle reaches a pole).
+    """
+    distance = float(km) / EARTH_RADIUS_KM
+    min_lat = lat - math.degrees(distance)
+    max_lat = lat + math.degrees(distance)
+    if min_lat <= -90 or max_lat >= 90:
+        return (max(min_lat, -90), min(max_lat, 90)), None
+    ratio = math.sin(distance) / math.cos(math.radians(lat))
+    if distance >= math.pi / 2 or ratio >= 1:
+        return (min_lat, max_lat), None
+    delta = math.degrees(math.asin(ratio))
+    min_lon, max_lon = lon - delta, lon + delta
+    if min_lon < -180:
+        return (min_lat, max_lat), [(min_lon + 360, 180), (-180, max_lon)]
+    if max_lon > 180:
+        return (min_lat, max_lat), [(min_lon, 180), (-180, max_lon - 360)]
+    return (min_lat, max_lat), [(min_lon, max_lon)]
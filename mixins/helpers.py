@@ -1,4 +1,5 @@
 from django import template
+from mixins.models import prefetch_vote_state
 import re
 
 class VariableNode(template.Node):
@@ -49,7 +50,7 @@ def list_page(request, model, subset, template_name='mixins/defaults/list_page.h
     parent_title = kwargs.get('parent_title', None)
     if callable(parent_title):
         parent_title = parent_title(kwargs)
-    top_objects = subset.globals().top_ten()
+    top_objects = prefetch_vote_state(subset.globals().top_ten())
     voteless_objects = subset.globals().voteless()
     title = kwargs.get('title', 'List')
     kwargs.update({'title': title, 'parent_title': parent_title, 'app_label': app_label, 'model_name': model_name, 'model_name_plural': model_name_plural, 'top_objects': top_objects, 'voteless_objects': voteless_objects, 'autosuggest_params': autosuggest_params})
@@ -0,0 +1,124 @@
+"""Cached vote rankings backing MixinQuerySet.top_n().
+
+A ranking is kept per model and per distinct queryset filter.  Each ranking stores the top
+instances as (id, score, total votes) rows, is adjusted in place whenever a vote changes, and
+is rebuilt from the database once it is older than the configured staleness bound.
+
+Settings to be placed in settings.py:
+    MIXINS_LEADERBOARD: if True, top_n() is served from the cached rankings (default False)
+    MIXINS_LEADERBOARD_CACHE: cache backend URI used to store rankings (default: the site cache)
+    MIXINS_LEADERBOARD_SIZE: number of rows kept per ranking (default 50)
+    MIXINS_LEADERBOARD_MAX_AGE: seconds a ranking may be served before it's rebuilt (default 300)
+"""
+from django.conf import settings
+from django.core.cache import cache, get_cache
+import hashlib
+import time
+
+_backend = None
+
+def enabled():
+    return getattr(settings, 'MIXINS_LEADERBOARD', False)
+
+def backend():
+    """Return the cache the rankings live in."""
+    global _backend
+    if _backend is None:
+        uri = getattr(settings, 'MIXINS_LEADERBOARD_CACHE', None)
+        _backend = uri and get_cache(uri) or cache
+    return _backend
+
+def _model_key(model):
+    return 'mixins:leaderboard:%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+def _board_key(queryset):
+    # repr() of the SQL and its parameters is ASCII even when the parameters are non-ASCII unicode.
+    query = repr(queryset.query.get_compiler(queryset.db).as_sql())
+    return '%s:%s' % (_model_key(queryset.model), hashlib.md5(query).hexdigest())
+
+def _sort_key(row):
+    object_id, score, total = row
+    return (-score, total)
+
+def _store(key, board):
+    max_age = getattr(settings, 'MIXINS_LEADERBOARD_MAX_AGE', 300)
+    remaining = int(board['created'] + max_age - time.time())
+    if remaining > 0:
+        backend().set(key, board, remaining)
+    else:
+        backend().delete(key)
+
+def top_n(queryset, n):
+    """Return the top n instances of queryset by vote, using the cached ranking when it is fresh."""
+    key = _board_key(queryset)
+    board = backend().get(key)
+    if board is not None and (len(board['rows']) >= n or board['complete']):
+        ids = [row[0] for row in board['rows'][:n]]
+        objects = queryset.in_bulk(ids)
+        return [objects[id] for id in ids if id in objects]
+
+    size = max(n, getattr(settings, 'MIXINS_LEADERBOARD_SIZE', 50))
+    objects = list(queryset.by_votes()[:size])
+    board = {'created': time.time(),
+             'complete': len(objects) < size,
+             'rows': [(obj.pk, obj.vote_score, obj.total_votes) for obj in objects]}
+    _store(key, board)
+
+    model_key = _model_key(queryset.model)
+    board_keys = backend().get(model_key) or []
+    if key not in board_keys:
+        board_keys.append(key)
+        backend().set(model_key, board_keys)
+    return objects[:n]
+
+def record_vote(model, object_id, old_vote, new_vote):
+    """Adjust every cached ranking of model for a single vote change (either vote may be None).
+
+    Rankings that can't be adjusted safely (e.g. an unranked instance may have moved into the
+    top rows) are dropped and rebuilt on the next read.  Rankings that have expired are removed
+    from the model's list of rankings.
+    """
+    if not enabled():
+        return
+    score_delta = (new_vote or 0) - (old_vote or 0)
+    total_delta = (new_vote is not None) - (old_vote is not None)
+    model_key = _model_key(model)
+    board_keys = backend().get(model_key) or []
+    expired = []
+    for key in board_keys:
+        board = backend().get(key)
+        if board is None:
+            expired.append(key)
+            continue
+        rows = board['rows']
+        position = None
+        for index, row in enumerate(rows):
+            if row[0] == object_id:
+                position = index
+                break
+
+        if position is None:
+            # An unranked instance that already had votes can only get worse without affecting a
+            # partial ranking, and a complete ranking already holds every voted instance in the
+            # filter.  A voteless instance's first vote may place it anywhere.
+            getting_worse = score_delta < 0 or (score_delta == 0 and total_delta > 0)
+            if old_vote is not None and (board['complete'] or getting_worse):
+                continue
+            backend().delete(key)
+            continue
+
+        bottom = _sort_key(rows[-1])
+        object_id, score, total = rows.pop(position)
+        row = (object_id, score + score_delta, total + total_delta)
+        if row[2] > 0:
+            rows.append(row)
+            rows.sort(key=_sort_key)
+            if not board['complete'] and _sort_key(row) > bottom:
+                # Unranked instances may now outrank this one, so only the rows above it are known.
+                del rows[rows.index(row):]
+        _store(key, board)
+    
+    if expired:
+        # Read the list again so rankings added meanwhile by top_n() aren't lost.
+        board_keys = [key for key in backend().get(model_key) or [] if key not in expired]
+        backend().set(model_key, board_keys)
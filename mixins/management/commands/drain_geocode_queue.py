@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from mixins import geocoding
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Number of queued rows read and written back at a time.'),
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of geocoding threads (default: MIXINS_GEOCODER_WORKERS).'),
+        make_option('--rate', type='float', dest='rate', default=None,
+                    help='Most geocoder requests per second (default: MIXINS_GEOCODER_RATE).'),
+        make_option('--retries', type='int', dest='retries', default=2,
+                    help='Number of times a failed lookup is retried within a run.'),
+        make_option('--max-attempts', type='int', dest='max_attempts', default=3,
+                    help='Number of runs a row may fail in before it is dropped from the queue.'),
+    )
+    help = 'Geocode the LocationMixin instances queued by deferred saves.'
+    
+    def handle(self, *args, **options):
+        geocoded, failed = geocoding.drain(options['batch_size'], options['workers'], options['rate'],
+                                           options['retries'], options['max_attempts'])
+        print "Geocoded %d queued instances, %d failed" % (geocoded, failed)
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from django.db.models import get_models
+from mixins import search
+from mixins.models import AutosuggestMixin
+
+class Command(NoArgsCommand):
+    help = 'Rebuild the autosuggest index used by mixins.search.IndexBackend for every AutosuggestMixin model.'
+    
+    def handle_noargs(self, **options):
+        for model in get_models():
+            if issubclass(model, AutosuggestMixin):
+                search.rebuild(model)
+                print "Rebuilt autosuggest index for %s.%s" % (model._meta.app_label, model._meta.object_name)
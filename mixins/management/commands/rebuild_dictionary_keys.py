@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from django.db.models import get_models
+from mixins.models import indexed_dictionary_fields, rebuild_dictionary_keys
+
+class Command(NoArgsCommand):
+    help = 'Rebuild the DictionaryKey rows of every model with a DictionaryField declaring indexed_keys.'
+    
+    def handle_noargs(self, **options):
+        for model in get_models():
+            if indexed_dictionary_fields(model):
+                rebuild_dictionary_keys(model)
+                print "Rebuilt dictionary keys for %s.%s" % (model._meta.app_label, model._meta.object_name)
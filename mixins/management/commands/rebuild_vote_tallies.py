@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from django.db.models import get_models
+from mixins.models import VoteTallyMixin, rebuild_vote_tallies
+
+class Command(NoArgsCommand):
+    help = 'Recompute the stored vote totals of every VoteTallyMixin model from UserVote.'
+    
+    def handle_noargs(self, **options):
+        for model in get_models():
+            if issubclass(model, VoteTallyMixin):
+                rebuild_vote_tallies(model)
+                print "Rebuilt vote tallies for %s.%s" % (model._meta.app_label, model._meta.object_name)
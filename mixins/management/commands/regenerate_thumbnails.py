@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model, get_models
+from mixins.models import ImageMixin
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', dest='force', default=False,
+                    help='Rebuild thumbnails that already exist.'),
+    )
+    help = 'Generate the declared thumbnails of every ImageMixin instance, decoding each image once.'
+    args = '[app_label.ModelName ...]'
+    
+    def handle(self, *labels, **options):
+        if labels:
+            models = []
+            for label in labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Models must be given as app_label.ModelName, not %r.' % label)
+                model = get_model(app_label, model_name)
+                if model is None or not issubclass(model, ImageMixin):
+                    raise CommandError('%s is not an ImageMixin model.' % label)
+                models.append(model)
+        else:
+            models = [model for model in get_models() if issubclass(model, ImageMixin)]
+        
+        for model in models:
+            count = 0
+            for instance in model._base_manager.exclude(image='').exclude(image=None).iterator():
+                instance.create_thumbnails(force=options['force'])
+                count += 1
+            print "Processed %d %s.%s images" % (count, model._meta.app_label, model._meta.object_name)
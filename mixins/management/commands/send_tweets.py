@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from mixins import tweeting
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--rate', type='float', dest='rate', default=None,
+                    help='Most tweets per second (default: MIXINS_TWITTER_RATE).'),
+        make_option('--retries', type='int', dest='retries', default=2,
+                    help='Number of times a failed tweet is retried within a run.'),
+        make_option('--max-attempts', type='int', dest='max_attempts', default=3,
+                    help='Number of runs a tweet may fail in before it is given up on.'),
+        make_option('--loop', type='int', dest='loop', default=0,
+                    help='Keep running, checking the queue every LOOP seconds.'),
+    )
+    help = 'Send the tweets queued by TwitterMixin.tweet().'
+    
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = tweeting.send(rate=options['rate'], retries=options['retries'],
+                                         max_attempts=options['max_attempts'])
+            if sent or failed or not options['loop']:
+                print "Sent %d queued tweets, %d failed" % (sent, failed)
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -1,29 +1,111 @@
+"""Settings to be placed in settings.py:
+    MIXINS_DOMAIN_CACHE_SIZE: number of hosts whose parsed domain/subdomain are kept (default 1000)
+    MIXINS_DOMAIN_OWNER_MODEL: 'app_label.ModelName' of a DomainMixin model; if set, DomainMiddleware
+        sets request.domain_owner to the instance whose subdomain (or custom domain) was requested
+    MIXINS_DOMAIN_OWNER_TIMEOUT: seconds an owner lookup is cached (default 300)
+
+Owner lookups are cached in the site cache and cleared whenever an instance of the owner model
+is saved or deleted.
+"""
+from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db.models import get_model
 from django.http import Http404
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_str
+import hashlib
+import threading
+
+_hosts = SortedDict()
+_lock = threading.Lock()
+
+def parse_host(host, site_domain):
+    """Return (domain, subdomain, main_domain) for a host, as set on the request by DomainMiddleware."""
+    host = host.replace('www.', '')
+    domain_pieces = host.split('.')
+    
+    if len(domain_pieces) <= 2:
+        domain = host.strip()
+        subdomain = ''
+    else:
+        domain = '.'.join(domain_pieces[1:]).strip()
+        subdomain = domain_pieces[0].strip()
+    
+    if site_domain == domain:
+        return '', subdomain, subdomain == ''
+    return host, '', False
+
+def resolve_host(host):
+    """Return parse_host() for the current site, from the in-process LRU map when the host was seen before."""
+    key = (host, Site.objects.get_current().domain)
+    _lock.acquire()
+    try:
+        if key in _hosts:
+            value = _hosts.pop(key)
+            _hosts[key] = value
+            return value
+    finally:
+        _lock.release()
+    value = parse_host(*key)
+    _lock.acquire()
+    try:
+        _hosts[key] = value
+        while len(_hosts) > getattr(settings, 'MIXINS_DOMAIN_CACHE_SIZE', 1000):
+            del _hosts[_hosts.keys()[0]]
+    finally:
+        _lock.release()
+    return value
+
+def owner_model():
+    path = getattr(settings, 'MIXINS_DOMAIN_OWNER_MODEL', None)
+    if path:
+        return get_model(*path.split('.'))
+    return None
+
+def _owner_key(field, value):
+    return 'mixins:domainowner:%s:%s' % (field, hashlib.md5(smart_str(value)).hexdigest())
+
+def get_owner(field, value):
+    """Return the owner model instance whose field ('subdomain' or 'domain') is value, or None.
+    
+    None is also returned when several instances share the value.
+    """
+    model = owner_model()
+    if model is None or not value:
+        return None
+    key = _owner_key(field, value)
+    owner = cache.get(key)
+    if owner is None:
+        try:
+            owner = model._default_manager.get(**{field: value})
+        except (model.DoesNotExist, model.MultipleObjectsReturned):
+            # domain isn't unique; a domain shared by several owners has none.
+            owner = False # cache misses too
+        cache.set(key, owner, getattr(settings, 'MIXINS_DOMAIN_OWNER_TIMEOUT', 300))
+    return owner or None
+
+def forget_owner(instance):
+    """Clear the cached lookups of a DomainMixin instance, under its current and loaded domain/subdomain."""
+    model = owner_model()
+    if model is None or not isinstance(instance, model):
+        return
+    domain, subdomain = instance._domainSource
+    for field, value in (('domain', instance.domain), ('subdomain', instance.subdomain),
+                         ('domain', domain), ('subdomain', subdomain)):
+        if value:
+            cache.delete(_owner_key(field, value))
 
 class DomainMiddleware:
     
     def process_request(self, request):
         """Parse out the subdomain from the request"""
-        request.domain = ''
-        request.subdomain = ''
-        request.main_domain = False
-        host = request.get_host().replace('www.', '')
-        domain_pieces = host.split('.')
-        
-        if len(domain_pieces) <= 2:
-            domain = host.strip()
-            subdomain = ''
-        else:
-            domain = '.'.join(domain_pieces[1:]).strip()
-            subdomain = domain_pieces[0].strip()
-        
-        if Site.objects.get_current().domain == domain:
-            request.subdomain = subdomain
-            if subdomain == '':
-                request.main_domain = True
-        else:
-            request.domain = host
+        request.domain, request.subdomain, request.main_domain = resolve_host(request.get_host())
+        request.domain_owner = None
+        if request.subdomain:
+            request.domain_owner = get_owner('subdomain', request.subdomain)
+        elif request.domain:
+            request.domain_owner = get_owner('domain', request.domain)
         
 class LockdownMiddleware:
 
@@ -31,4 +113,3 @@ class LockdownMiddleware:
         if not "/admin/" in request.META['PATH_INFO'] and not request.user.is_staff:
             raise Http404
         return None
-
@@ -6,12 +6,19 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.exceptions import FieldError
 from django.core.urlresolvers import NoReverseMatch, reverse
-from django.db import models
-from django.db.models import Q, Sum, Count
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F, Q, Sum, Count
 from django.db.models.query import QuerySet
 from django.template.defaultfilters import slugify
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext as _
+from mixins import geocoding, leaderboard, middleware, search, thumbnails, tweeting
+from mixins.thumbnails import ImageThumbEnum
 from mixins.views import *
+import datetime
+import hashlib
 import os
 
 class MixinManager(models.Manager):
@@ -44,29 +51,49 @@ class BaseMixin(models.Model):
                 return self.all()
         
         def top_n(self, n):
+            """Return the n highest voted instances, from the cached leaderboard if it's enabled."""
+            if leaderboard.enabled() and issubclass(self.model, VoteMixin):
+                return leaderboard.top_n(self, n)
             return self.by_votes()[:n]
         
         def top_ten(self):
             return self.top_n(10)
         
         def by_votes(self):
-            """Order the models based on their votes, tie goes to instance with fewest total votes."""
-            try:
-                query_set = UserVote.objects.filter(content_type=self.model().contenttype().id,
-                                                    object_id__in=self.values_list('id', flat=True)
-                                                    ).annotate(vote_score=Sum('vote'),
-                                                               total_votes=Count('vote')
-                                                               ).order_by('-vote_score',
-                                                                          'total_votes'
-                                                                          ).values('object_id',
-                                                                                   'vote_score',
-                                                                                   'total_votes')
-                query_set.query.group_by = ['object_id']
-                ids = [obj['object_id'] for obj in query_set]
-                objects = self.select_related().in_bulk(ids)
-                return [objects[id] for id in ids]
-            except FieldError:
+            """Order the models based on their votes, tie goes to instance with fewest total votes.
+            
+            Only instances with at least one vote are returned.  The score is computed by the database
+            (or read from the VoteTallyMixin columns), so the result is still a lazy queryset and
+            slicing it applies the LIMIT in SQL.
+            """
+            if not issubclass(self.model, VoteMixin):
                 return self.all()
+            qn = connection.ops.quote_name
+            table = qn(self.model._meta.db_table)
+            if issubclass(self.model, VoteTallyMixin):
+                total = '%s.%s + %s.%s' % (table, qn('vote_up_count'), table, qn('vote_down_count'))
+                return self.filter(Q(vote_up_count__gt=0) | Q(vote_down_count__gt=0)
+                                   ).extra(select={'total_votes': total}
+                                           ).order_by('-vote_score', 'total_votes')
+            vote_table = qn(UserVote._meta.db_table)
+            votes = 'FROM %s WHERE %s.%s = %%s AND %s.%s = %s.%s' % (vote_table,
+                                                                      vote_table, qn('content_type_id'),
+                                                                      vote_table, qn('object_id'),
+                                                                      table, qn(self.model._meta.pk.column))
+            ct = ContentType.objects.get_for_model(self.model).id
+            select = SortedDict([('vote_score', 'SELECT SUM(%s.%s) %s' % (vote_table, qn('vote'), votes)),
+                                 ('total_votes', 'SELECT COUNT(*) %s' % votes)])
+            return self.extra(select=select, select_params=(ct, ct),
+                              where=['EXISTS (SELECT 1 %s)' % votes], params=[ct]
+                              ).order_by('-vote_score', 'total_votes')
+        
+        def with_keys(self, field_name, **values):
+            """Filter to instances whose DictionaryField holds each key=value given. See with_keys."""
+            return with_keys(self, field_name, **values)
+        
+        def with_vote_state(self, user=None):
+            """Evaluate the queryset, loading vote totals (and user's votes) in grouped queries. See prefetch_vote_state."""
+            return prefetch_vote_state(self, user)
         
         def voteless(self):
             try:
@@ -82,13 +109,99 @@ class BaseMixin(models.Model):
                 return self.order_by('-created_at')
             except FieldError:
                 return self.all()
-    
+        
     class Meta:
         abstract = True
 
-class DictionaryField(models.Field):
+class TrackedDict(dict):
+    """Dictionary decoded from DictionaryField JSON, remembering that JSON until it's changed."""
+    
+    def __init__(self, value, raw):
+        super(TrackedDict, self).__init__(value)
+        self.raw = raw
+        for value in self.itervalues():
+            if isinstance(value, (list, dict)):
+                # Nested values can change without the dictionary noticing.
+                self.raw = None
+                break
+    
+    def changed(method):
+        def wrapper(self, *args, **kwargs):
+            self.raw = None
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        return wrapper
+    
+    __setitem__ = changed(dict.__setitem__)
+    __delitem__ = changed(dict.__delitem__)
+    clear = changed(dict.clear)
+    pop = changed(dict.pop)
+    popitem = changed(dict.popitem)
+    setdefault = changed(dict.setdefault)
+    update = changed(dict.update)
+    del changed
+
+class JSONText(unicode):
+    """Undecoded DictionaryField JSON, as given to the model's constructor."""
+    pass
+
+class DictionaryDescriptor(object):
+    """Keeps a DictionaryField's JSON undecoded on the instance until the attribute is read.
+    
+    Only the string the field is initialized with (by the model's constructor, which is how rows
+    are loaded) is taken as JSON; strings assigned later are values, saved as JSON strings.
+    """
+    
+    def __init__(self, field):
+        self.field = field
+    
+    def __get__(self, instance, owner):
+        if instance is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        value = instance.__dict__[self.field.name]
+        if isinstance(value, JSONText) and value != '':
+            raw = unicode(value)
+            value = simplejson.loads(raw)
+            if isinstance(value, dict):
+                value = TrackedDict(value, raw)
+            if not isinstance(value, basestring):
+                # Strings stay raw JSON on the instance, so a decoded string is decoded again next time.
+                instance.__dict__[self.field.name] = value
+        return value
+    
+    def __set__(self, instance, value):
+        if isinstance(value, basestring) and self.field.name not in instance.__dict__:
+            value = JSONText(force_unicode(value))
+        instance.__dict__[self.field.name] = value
 
-    __metaclass__ = models.SubfieldBase
+class DictionaryField(models.Field):
+    """Stores a dictionary as JSON.
+    
+    Keyword arguments:
+        indexed_keys: keys whose values are copied to DictionaryKey rows when an instance is saved,
+            so with_keys() can match them through an index (run rebuild_dictionary_keys after
+            adding keys to an existing model)
+        native: if True, use a jsonb column on PostgreSQL (text elsewhere)
+    
+    Match values of single keys with with_keys(queryset, field, key=value) or the with_keys()
+    queryset method of BaseMixin models.  The contains/icontains lookups take a string, a
+    (key, value) tuple or a one item dictionary and match the stored JSON text.
+    
+    The JSON loaded from the database is only decoded when the attribute is first read, and is
+    saved back as is unless the dictionary was changed.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        self.indexed_keys = tuple(kwargs.pop('indexed_keys', ()))
+        self.native = kwargs.pop('native', False)
+        super(DictionaryField, self).__init__(*args, **kwargs)
+    
+    def contribute_to_class(self, cls, name):
+        super(DictionaryField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, DictionaryDescriptor(self))
+        if self.indexed_keys and not cls._meta.abstract:
+            models.signals.post_save.connect(dictionary_keys_saved, sender=cls)
+            models.signals.post_delete.connect(dictionary_keys_deleted, sender=cls)
 
     def to_python(self, value):
         if isinstance(value, dict) or value == '':
@@ -96,26 +209,38 @@ class DictionaryField(models.Field):
         return simplejson.loads(value)
     
     def get_db_prep_value(self, value):
-        if value == '':
-            return value
+        if isinstance(value, JSONText) or value == '':
+            return unicode(value)
+        if isinstance(value, TrackedDict) and value.raw is not None:
+            return value.raw
         return simplejson.dumps(value)
     
     def get_db_prep_lookup(self, lookup_type, value):
+        if lookup_type == 'isnull':
+            return []
         if lookup_type != 'contains' and lookup_type != 'icontains':
             raise TypeError('Lookup type %r not supported.' % lookup_type)
         elif not isinstance(value, str) and not isinstance(value, unicode) and not isinstance(value, tuple) and not isinstance(value, list) and not isinstance(value, dict):
             raise ValueError('Must pass a string, tuple, list or dictionary.')
         
         if isinstance(value, str) or isinstance(value, unicode):
-            return ['%s%s%s' % ('%', value, '%')]
+            return ['%%%s%%' % connection.ops.prep_for_like_query(value)]
         elif isinstance(value, dict):
             if len(value) != 1:
                 raise ValueError('Input must be of length one.')
-            return ['%s"%s": "%s"%s' % ('%', value.keys()[0], value[value.keys()[0]], '%')]
+            return ['%%%s%%' % connection.ops.prep_for_like_query(json_item(*value.items()[0]))]
         else:
             if len(value) != 2:
                 raise ValueError('Input must be of length two.')
-            return ['%s"%s": "%s"%s' % ('%', value[0], value[1], '%')]
+            return ['%%%s%%' % connection.ops.prep_for_like_query(json_item(value[0], value[1]))]
+    
+    def is_native(self):
+        return self.native and 'postgresql' in connection.settings_dict['ENGINE']
+    
+    def db_type(self):
+        if self.is_native():
+            return 'jsonb'
+        return super(DictionaryField, self).db_type()
     
     def get_internal_type(self):
         return 'TextField'
@@ -125,9 +250,101 @@ add_introspection_rules([
     (
         [DictionaryField],
         [],
-        {},
+        {
+            'indexed_keys': ['indexed_keys', {'default': ()}],
+            'native': ['native', {'default': False}],
+        },
     ),
 ], ["^mixins\.models\.DictionaryField"])
+
+def json_item(key, value):
+    """Return how key: value appears in the JSON written by DictionaryField."""
+    return '%s: %s' % (simplejson.dumps(key), simplejson.dumps(value))
+
+def dictionary_key_value(value):
+    """Return the DictionaryKey.value stored for a dictionary value: its JSON, or a hash of it if that's too long."""
+    value = simplejson.dumps(value)
+    if len(value) > 255:
+        value = 'sha1:%s' % hashlib.sha1(value).hexdigest()
+    return value
+
+class DictionaryKey(models.Model):
+    """Value of a key listed in a DictionaryField's indexed_keys, used by with_keys()."""
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField(db_index=True)
+    field = models.CharField(max_length=50)
+    key = models.CharField(max_length=100)
+    value = models.CharField(max_length=255, db_index=True)
+    
+    def __unicode__(self):
+        return '%s=%s' % (self.key, self.value)
+
+def indexed_dictionary_fields(model):
+    return [field for field in model._meta.fields if isinstance(field, DictionaryField) and field.indexed_keys]
+
+def dictionary_keys(instance, field):
+    """Return the (key, value) DictionaryKey pairs of one field of an instance."""
+    dictionary = getattr(instance, field.attname)
+    if not isinstance(dictionary, dict):
+        return []
+    return [(key, dictionary_key_value(dictionary[key])) for key in field.indexed_keys if key in dictionary]
+
+def dictionary_keys_saved(sender, instance, **kwargs):
+    """Keep the DictionaryKey rows of an instance current."""
+    ct = ContentType.objects.get_for_model(instance)
+    for field in indexed_dictionary_fields(sender):
+        pairs = dictionary_keys(instance, field)
+        rows = DictionaryKey.objects.filter(content_type=ct, object_id=instance.pk, field=field.name)
+        if sorted(rows.values_list('key', 'value')) == sorted(pairs):
+            continue
+        rows.delete()
+        for key, value in pairs:
+            DictionaryKey.objects.create(content_type=ct, object_id=instance.pk, field=field.name, key=key, value=value)
+
+def dictionary_keys_deleted(sender, instance, **kwargs):
+    DictionaryKey.objects.filter(content_type=ContentType.objects.get_for_model(instance), object_id=instance.pk).delete()
+
+@transaction.commit_on_success
+def rebuild_dictionary_keys(model, batch_size=1000):
+    """Replace the DictionaryKey rows of a model with freshly computed ones."""
+    ct = ContentType.objects.get_for_model(model)
+    DictionaryKey.objects.filter(content_type=ct).delete()
+    sql = 'INSERT INTO %s (content_type_id, object_id, field, %s, value) VALUES (%%s, %%s, %%s, %%s, %%s)' % (
+        connection.ops.quote_name(DictionaryKey._meta.db_table), connection.ops.quote_name('key'))
+    cursor = connection.cursor()
+    rows = []
+    fields = indexed_dictionary_fields(model)
+    for instance in model._base_manager.only('pk', *[field.name for field in fields]).iterator():
+        for field in fields:
+            rows.extend([(ct.id, instance.pk, field.name, key, value) for key, value in dictionary_keys(instance, field)])
+        if len(rows) >= batch_size:
+            cursor.executemany(sql, rows)
+            rows = []
+    if rows:
+        cursor.executemany(sql, rows)
+
+def with_keys(objects, field_name, **values):
+    """Filter objects to instances whose field_name dictionary holds each key=value given.
+    
+    Keys in the field's indexed_keys are matched exactly through DictionaryKey.  Other keys use
+    jsonb containment on native columns, or else a LIKE on the JSON text, which can also match
+    the key inside a nested dictionary.
+    """
+    model = objects.model
+    field = model._meta.get_field(field_name)
+    column = '%s.%s' % (connection.ops.quote_name(model._meta.db_table), connection.ops.quote_name(field.column))
+    for key, value in values.items():
+        if key in field.indexed_keys:
+            entries = DictionaryKey.objects.filter(content_type=ContentType.objects.get_for_model(model), field=field.name,
+                                                   key=key, value=dictionary_key_value(value))
+            objects = objects.filter(pk__in=entries.values('object_id'))
+        elif field.is_native():
+            objects = objects.extra(where=['%s @> %%s' % column], params=[simplejson.dumps({key: value})])
+        else:
+            like = '%s %s' % (connection.ops.lookup_cast('contains') % column, connection.operators['contains'])
+            pattern = connection.ops.prep_for_like_query(json_item(key, value))
+            objects = objects.extra(where=['(%s OR %s)' % (like, like)], params=['%%%s,%%' % pattern, '%%%s}%%' % pattern])
+    return objects
         
 class DeleteMixin(BaseMixin):
     """Implements soft deletes which will only be available from the admin section."""
@@ -174,16 +391,40 @@ class SimpleLocationMixin(models.Model):
         return ', '.join([field for field in (self.city, self.state) if field != ''])
 
 class LocationMixin(SimpleLocationMixin):
-    """Uses Google geocoder to determine latitude/longitude for model during save."""
+    """Uses the geocoder configured in mixins.geocoding to determine latitude/longitude for model during save.
+    
+    Existing instances are only geocoded again when an address field changed since they were loaded.
+    If geocodeDeferred is True (default: the MIXINS_GEOCODE_DEFERRED setting), save() zeroes the
+    coordinates and queues the instance for the drain_geocode_queue command instead.
+    
+    Each concrete model also gets a locations manager, next to its default manager, whose
+    within_radius(lat, lon, km) and nearest(lat, lon, n) find instances by distance: a box around
+    the point is selected through the latitude/longitude indexes, then exact distances are
+    computed for the rows inside it.  Instances at 0,0 are treated as not geocoded and never
+    returned.
+    """
     address = models.CharField(max_length=100)
     address2 = models.CharField(max_length=100, blank=True)
     zip = models.CharField(max_length=12)
     country = models.CharField(max_length=50, default='US')
-    latitude = models.FloatField(default=0)
-    longitude = models.FloatField(default=0)
+    latitude = models.FloatField(default=0, db_index=True)
+    longitude = models.FloatField(default=0, db_index=True)
     
     class Meta:
         abstract = True
+    
+    ADDRESS_FIELDS = ('address', 'address2', 'city', 'state', 'zip', 'country')
+    geocodeDeferred = None
+    
+    def __init__(self, *args, **kwargs):
+        super(LocationMixin, self).__init__(*args, **kwargs)
+        # Read from __dict__ so deferred fields aren't loaded; None forces geocoding on save.
+        self._addressSource = None
+        if self.pk is not None and all([name in self.__dict__ for name in self.ADDRESS_FIELDS]):
+            self._addressSource = self.addressValues()
+    
+    def addressValues(self):
+        return tuple([getattr(self, name) for name in self.ADDRESS_FIELDS])
         
     def buildFullAddress(self):
         full = []
@@ -197,23 +438,119 @@ class LocationMixin(SimpleLocationMixin):
         
     def save(self):
         do_save = True
-        if self.address != '':
-            try:
-                from geopy import geocoders
-                g = geocoders.Google('ABQIAAAAYksysDw0in8NRjwEFBJXaxTlfjA2irq0rOHwKfqbHkNeo2dq3RQJjhlAeJUpxWojw0yxWl099pfJvQ')
-                addresses = list(g.geocode(self.buildFullAddress(), exactly_one=False))
-                if len(addresses) == 1:
-                    self.latitude, self.longitude = addresses[0][1]
-                else:
-                    self.latitude = 0
-                    self.longitude = 0
-                    self.potential_addresses = addresses
-                    #do_save = False
-            except ImportError:
+        source = self.addressValues()
+        deferred = self.geocodeDeferred
+        if deferred is None:
+            deferred = getattr(settings, 'MIXINS_GEOCODE_DEFERRED', False)
+        changed = self.address != '' and source != self._addressSource
+        if changed and deferred:
+            self.latitude = 0
+            self.longitude = 0
+        elif changed:
+            addresses = geocoding.geocode(self.buildFullAddress())
+            if len(addresses) == 1:
+                self.latitude, self.longitude = addresses[0][1]
+            else:
                 self.latitude = 0
                 self.longitude = 0
+                self.potential_addresses = addresses
+                #do_save = False
         if do_save:
             super(LocationMixin, self).save()
+            self._addressSource = source
+            if changed and deferred:
+                geocoding.defer(self)
+
+class LocationQuerySet(QuerySet):
+    """Distance queries for LocationMixin models."""
+    
+    def within_box(self, lat, lon, km):
+        """Filter to geocoded instances inside the latitude/longitude box around a km radius of lat/lon.
+        
+        This is the indexed prefilter of within_radius(); some instances may be further than km away.
+        """
+        (min_lat, max_lat), longitudes = geocoding.bounding_box(lat, lon, km)
+        set = self.exclude(latitude=0, longitude=0).filter(latitude__range=(min_lat, max_lat))
+        if longitudes is not None:
+            q = Q()
+            for min_lon, max_lon in longitudes:
+                q |= Q(longitude__range=(min_lon, max_lon))
+            set = set.filter(q)
+        return set
+    
+    def within_radius(self, lat, lon, km):
+        """Return the geocoded instances within km of lat/lon, nearest first, each with a distance attribute in km."""
+        objects = []
+        for object in self.within_box(lat, lon, km):
+            object.distance = geocoding.haversine(lat, lon, object.latitude, object.longitude)
+            if object.distance <= km:
+                objects.append(object)
+        objects.sort(key=lambda object: object.distance)
+        return objects
+    
+    def nearest(self, lat, lon, n=10, km=10):
+        """Return the n geocoded instances nearest to lat/lon, each with a distance attribute in km.
+        
+        The search starts within km and doubles its radius until n instances are found.
+        """
+        while True:
+            objects = self.within_radius(lat, lon, km)
+            if len(objects) >= n or km >= geocoding.HALF_CIRCUMFERENCE_KM:
+                return objects[:n]
+            km *= 2
+
+class LocationManager(models.Manager):
+    """Manager of LocationMixin models returning LocationQuerySets.  Filters out deleted instances, if possible."""
+    
+    def get_query_set(self):
+        set = LocationQuerySet(self.model)
+        try:
+            return set.filter(deleted=False)
+        except FieldError:
+            return set
+    
+    def within_box(self, lat, lon, km):
+        return self.get_query_set().within_box(lat, lon, km)
+    
+    def within_radius(self, lat, lon, km):
+        return self.get_query_set().within_radius(lat, lon, km)
+    
+    def nearest(self, lat, lon, n=10, km=10):
+        return self.get_query_set().nearest(lat, lon, n, km)
+
+def add_location_manager(sender, **kwargs):
+    """Give a LocationMixin model its locations manager.
+    
+    It's added once the model is prepared, so it's created after the model's own managers and
+    never becomes the default manager.
+    """
+    if issubclass(sender, LocationMixin) and 'locations' not in sender.__dict__:
+        sender.add_to_class('locations', LocationManager())
+models.signals.class_prepared.connect(add_location_manager)
+
+class PendingGeocode(models.Model):
+    """LocationMixin instance waiting to be geocoded by mixins.geocoding.drain."""
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    address = models.TextField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+    
+    def __unicode__(self):
+        return self.address
+
+class GeocodedAddress(models.Model):
+    """Geocoder results for a normalized address, used by mixins.geocoding.geocode."""
+    key = models.CharField(max_length=40, unique=True)
+    address = models.TextField()
+    results = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __unicode__(self):
+        return self.address
 
 class SlugMixin(models.Model):
     """Add a slug field based on a certain field.
@@ -222,24 +559,59 @@ class SlugMixin(models.Model):
         uniqueSlug: if True, will force unique slugs for the model (append _# if conflict)
         slugNewOnly: if True, will only create slug for new instance
         slugValue: string value of field to use for slug
+        slugRetries: number of times a save is attempted when it loses a race for a unique slug
+            (only applies if the slug column has a unique index)
+    
+    Existing instances only get a new slug when the slugValue field changed since they were loaded.
     """
     slug = models.SlugField(editable=False, db_index=True)
     uniqueSlug = False
     slugNewOnly = False
+    slugRetries = 3
     
     class Meta:
         abstract = True
     
+    def __init__(self, *args, **kwargs):
+        super(SlugMixin, self).__init__(*args, **kwargs)
+        # Read from __dict__ so deferred fields aren't loaded; None forces regeneration on save.
+        self._slugSource = self.__dict__.get(getattr(self, 'slugValue', None))
+    
+    def buildSlug(self):
+        try:
+            if self.uniqueSlug:
+                return SlugifyUniquely(getattr(self, self.slugValue), self.__class__, exclude=self.pk)
+            else:
+                return slugify(getattr(self, self.slugValue))
+        except AttributeError:
+            print "Need to define slugValue for main class."
+            return self.slug
+    
     def save(self):
-        if not self.slugNewOnly or not self.id:
+        source = getattr(self, getattr(self, 'slugValue', ''), None)
+        if not self.id:
+            regenerate = True
+        else:
+            regenerate = not self.slugNewOnly and (not self.slug or self._slugSource is None or source != self._slugSource)
+        if regenerate:
+            self.slug = self.buildSlug()
+        if not regenerate or not self.uniqueSlug:
+            super(SlugMixin, self).save()
+            self._slugSource = source
+            return
+        for attempt in range(self.slugRetries):
+            sid = transaction.savepoint()
             try:
-                if self.uniqueSlug:
-                    self.slug = SlugifyUniquely(getattr(self, self.slugValue), self.__class__)
-                else:
-                    self.slug = slugify(getattr(self, self.slugValue))
-            except AttributeError:
-                print "Need to define slugValue for main class."
-        super(SlugMixin, self).save()
+                super(SlugMixin, self).save()
+                transaction.savepoint_commit(sid)
+                self._slugSource = source
+                return
+            except IntegrityError:
+                # Another save took the slug between SlugifyUniquely and the INSERT/UPDATE.
+                transaction.savepoint_rollback(sid)
+                if attempt == self.slugRetries - 1:
+                    raise
+                self.slug = self.buildSlug()
 
 class UserMixin(models.Model):
     
@@ -268,31 +640,107 @@ class UserVote(UserMixin, DateMixin):
     object_id = models.PositiveIntegerField()
     content_object = generic.GenericForeignKey()
     
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'user'),)
+    
     def __unicode__(self):
         return u"%s" % self.vote
 
+def cast_vote(content_type, object_id, user, vote):
+    """Atomically set user's up/down vote on an instance and return the vote it replaced (None if new).
+    
+    PostgreSQL 9.5 and later do this with a single INSERT ... ON CONFLICT statement.  Other
+    backends run a conditional UPDATE followed by an INSERT, which is retried if it loses a race
+    against the unique (content_type, object_id, user) index.
+    """
+    if _supports_upsert():
+        qn = connection.ops.quote_name
+        table = qn(UserVote._meta.db_table)
+        now = datetime.datetime.now()
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO %s (content_type_id, object_id, user_id, vote, created_at, modified_at) '
+                       'VALUES (%%s, %%s, %%s, %%s, %%s, %%s) '
+                       'ON CONFLICT (content_type_id, object_id, user_id) '
+                       'DO UPDATE SET vote = EXCLUDED.vote, modified_at = EXCLUDED.modified_at '
+                       'WHERE %s.vote <> EXCLUDED.vote '
+                       'RETURNING xmax = 0' % (table, table),
+                       [content_type.id, object_id, user.id, vote, now, now])
+        row = cursor.fetchone()
+        transaction.commit_unless_managed()
+        if row is None:
+            return vote
+        if row[0]:
+            return None
+        # xmax is only zero for freshly inserted rows; updates only happen when the vote flipped.
+        return -vote
+    
+    votes = UserVote.objects.filter(content_type=content_type, object_id=object_id, user=user)
+    for attempt in range(3):
+        if votes.exclude(vote=vote).update(vote=vote, modified_at=datetime.datetime.now()):
+            return -vote
+        sid = transaction.savepoint()
+        try:
+            UserVote.objects.create(content_type=content_type, object_id=object_id, user=user, vote=vote)
+            transaction.savepoint_commit(sid)
+            return None
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            if votes.filter(vote=vote).count():
+                return vote
+    raise IntegrityError('Unable to cast vote after %d attempts.' % (attempt + 1))
+
+def _supports_upsert():
+    """Return True if the database is PostgreSQL 9.5 or later, which understands ON CONFLICT."""
+    if 'postgresql' not in connection.settings_dict.get('ENGINE', ''):
+        return False
+    connection.cursor() # opens the connection, which reads the server version
+    version = getattr(connection.connection, 'server_version', None)
+    if version is None:
+        # Older psycopg2 releases; the backend keeps the version it parsed as a tuple.
+        parsed = getattr(connection, 'pg_version', None) or getattr(connection, '_version', None)
+        if isinstance(parsed, (tuple, list)):
+            version = parsed[0] * 10000 + (parsed[1] or 0) * 100
+        else:
+            version = parsed
+    return version is not None and version >= 90500
+
 class VoteMixin(BaseMixin):
     """Implements ability to track user up/down votes on any instance."""
     votes = generic.GenericRelation(UserVote, related_name="%(class)s_votes")
     uservote = None
+    uservote_user = None
     votevalue = None
+    voteupcount = None
+    votedowncount = None
     
     class Meta:
         abstract = True
     
     def vote(self, user, vote):
-        """Cast up/down vote for user."""
-        if int(vote) != - 1 and int(vote) != 1:
-            return
-        try:
-            old_vote = self.votes.filter(user=user)[0]
-            old_vote.vote = vote
-            old_vote.save()
-        except IndexError:
-            self.votes.create(vote=vote, user=user)
+        """Cast up/down vote for user. Returns True if the instance's score changed."""
+        vote = int(vote)
+        if vote != - 1 and vote != 1:
+            return False
+        old_vote = cast_vote(self.contenttype(), self.pk, user, vote)
+        if old_vote == vote:
+            return False
+        self.voteChanged(old_vote, vote)
+        return True
+    
+    def voteChanged(self, old_vote, new_vote):
+        """Called after a user's vote on the instance changes (either vote may be None)."""
+        self.resetVoteState()
+        record_vote_change(self.__class__, self.pk, old_vote, new_vote)
+    
+    def resetVoteState(self):
+        """Forget vote values cached on the instance by voteValue(), userVote() or prefetch_vote_state()."""
+        self.uservote = self.uservote_user = None
+        self.votevalue = self.voteupcount = self.votedowncount = None
     
     def userVote(self, user):
         """Returns the user's vote for the instance."""
+        if self.uservote_user is not None and self.uservote_user == user.pk:
+            return self.uservote
         try:
             self.uservote = self.votes.filter(user=user)[0]
         except IndexError:
@@ -305,7 +753,9 @@ class VoteMixin(BaseMixin):
     
     def voteUpCount(self):
         """Return total number of up-votes for instance."""
-        return self.voteUps().count()
+        if self.voteupcount is None:
+            self.voteupcount = self.voteUps().count()
+        return self.voteupcount
     
     def voteDowns(self):
         """Return all down-votes for instance."""
@@ -313,20 +763,281 @@ class VoteMixin(BaseMixin):
     
     def voteDownCount(self):
         """Return total number of down-votes for instance."""
-        return self.voteDowns().count()
+        if self.votedowncount is None:
+            self.votedowncount = self.voteDowns().count()
+        return self.votedowncount
     
     def voteValue(self):
         """Returns the net vote value for instance."""
-        self.votevalue = self.voteUpCount() - self.voteDownCount()
+        if self.votevalue is None:
+            self.votevalue = self.voteUpCount() - self.voteDownCount()
         return self.votevalue
     
     def clearVotes(self):
         self.votes.all().delete()
+        self.resetVoteState()
     
     def contenttype(self):
         """Helper method to get the contenttype for the model."""
         return ContentType.objects.get_for_model(self)
 
+class VoteTallyMixin(VoteMixin):
+    """VoteMixin that stores denormalized up/down/net vote totals on the instance.
+    
+    The totals are kept current by vote(), clearVotes() and UserVote deletes using atomic
+    F() updates, so reading the score costs no queries.  Run the rebuild_vote_tallies
+    management command after adding the mixin to an existing model or bulk loading votes.
+    """
+    vote_up_count = models.IntegerField(default=0, editable=False)
+    vote_down_count = models.IntegerField(default=0, editable=False)
+    vote_score = models.IntegerField(default=0, editable=False, db_index=True)
+    
+    class Meta:
+        abstract = True
+    
+    def voteChanged(self, old_vote, new_vote):
+        super(VoteTallyMixin, self).voteChanged(old_vote, new_vote)
+        up, down = vote_tally_delta(old_vote, new_vote)
+        self.vote_up_count += up
+        self.vote_down_count += down
+        self.vote_score += up - down
+    
+    def save(self):
+        # The totals are only changed through F() updates; reload them so a save doesn't undo
+        # votes cast since this instance was loaded.
+        if self.pk is not None:
+            rows = self.__class__._base_manager.filter(pk=self.pk).values_list('vote_up_count', 'vote_down_count', 'vote_score')
+            for up, down, score in rows:
+                self.vote_up_count, self.vote_down_count, self.vote_score = up, down, score
+        super(VoteTallyMixin, self).save()
+    
+    def voteUpCount(self):
+        """Return total number of up-votes for instance."""
+        return self.vote_up_count
+    
+    def voteDownCount(self):
+        """Return total number of down-votes for instance."""
+        return self.vote_down_count
+    
+    def voteValue(self):
+        """Returns the net vote value for instance."""
+        self.votevalue = self.vote_score
+        return self.votevalue
+    
+    def clearVotes(self):
+        super(VoteTallyMixin, self).clearVotes()
+        self.__class__.admin_manager.filter(pk=self.pk).update(vote_up_count=0, vote_down_count=0, vote_score=0)
+        self.vote_up_count = self.vote_down_count = self.vote_score = 0
+
+def vote_tally_delta(old_vote, new_vote):
+    """Return the (up, down) count changes caused by replacing old_vote with new_vote (either may be None)."""
+    up = down = 0
+    if old_vote == 1:
+        up -= 1
+    elif old_vote == -1:
+        down -= 1
+    if new_vote == 1:
+        up += 1
+    elif new_vote == -1:
+        down += 1
+    return up, down
+
+def adjust_vote_tallies(model, object_ids, up, down):
+    """Atomically add up/down vote counts to the stored totals of VoteTallyMixin instances."""
+    if up or down:
+        model.admin_manager.filter(pk__in=object_ids).update(vote_up_count=F('vote_up_count') + up,
+                                                             vote_down_count=F('vote_down_count') + down,
+                                                             vote_score=F('vote_score') + (up - down))
+
+def record_vote_change(model, object_id, old_vote, new_vote):
+    """Apply a single vote change to the denormalized vote state kept for an instance."""
+    leaderboard.record_vote(model, object_id, old_vote, new_vote)
+    if issubclass(model, VoteTallyMixin):
+        up, down = vote_tally_delta(old_vote, new_vote)
+        adjust_vote_tallies(model, [object_id], up, down)
+
+@transaction.commit_on_success
+def cast_votes(user, votes):
+    """Apply many of user's votes in one transaction and return the new net vote value of each instance.
+    
+    votes is a list of (content_type, object_id, vote) tuples with vote being 1 or -1.  Invalid votes,
+    missing instances and models that don't extend VoteMixin are skipped; the last vote given for an
+    instance wins.  Each model costs one query to validate the ids, one to read the user's existing
+    votes and one to read the new scores, plus a single multi-row INSERT for new votes and one UPDATE
+    per direction for changed votes.  Returns a dict mapping (content_type, object_id) to the score.
+    
+    If another request changed any of these votes after they were read (the INSERT hits the unique
+    index or an UPDATE matches fewer rows than expected), the batch writes are rolled back and the
+    changed votes are cast one at a time with cast_vote(), so each tally change is applied once.
+    Databases without savepoints can't roll the batch back, so there every vote goes through
+    cast_vote().
+    """
+    wanted = SortedDict()
+    for content_type, object_id, vote in votes:
+        try:
+            object_id, vote = int(object_id), int(vote)
+        except (TypeError, ValueError):
+            continue
+        if vote == 1 or vote == -1:
+            wanted.setdefault(content_type, {})[object_id] = vote
+    
+    now = datetime.datetime.now()
+    new_votes = []
+    changed_votes = {1: [], -1: []}
+    changes = []
+    touched = []
+    for content_type, objects in wanted.items():
+        model = content_type.model_class()
+        if model is None or not issubclass(model, VoteMixin):
+            continue
+        ids = list(model.objects.filter(pk__in=objects.keys()).values_list('pk', flat=True))
+        existing = {}
+        for object_id, id, vote in UserVote.objects.filter(content_type=content_type, object_id__in=ids, user=user
+                                                           ).values_list('object_id', 'id', 'vote'):
+            existing[object_id] = (id, vote)
+        for object_id in ids:
+            vote = objects[object_id]
+            if object_id in existing:
+                id, old_vote = existing[object_id]
+                if old_vote == vote:
+                    continue
+                changed_votes[vote].append(id)
+            else:
+                old_vote = None
+                new_votes.append((content_type.id, object_id, user.id, vote, now, now))
+            changes.append((content_type, model, object_id, old_vote, vote))
+        touched.append((content_type, model, ids))
+    
+    if not connection.features.uses_savepoints or not _write_votes(new_votes, changed_votes, now):
+        # Votes read above are stale; cast_vote reports what each write actually replaced.
+        changes = [(content_type, model, object_id, cast_vote(content_type, object_id, user, vote), vote)
+                   for content_type, model, object_id, old_vote, vote in changes]
+        changes = [change for change in changes if change[3] != change[4]]
+    
+    # Instances sharing the same tally change are updated together.
+    tallies = {}
+    for content_type, model, object_id, old_vote, vote in changes:
+        leaderboard.record_vote(model, object_id, old_vote, vote)
+        if issubclass(model, VoteTallyMixin):
+            tallies.setdefault((model, vote_tally_delta(old_vote, vote)), []).append(object_id)
+    for (model, (up, down)), ids in tallies.items():
+        adjust_vote_tallies(model, ids, up, down)
+    
+    scores = {}
+    for content_type, model, ids in touched:
+        for object_id in ids:
+            scores[(content_type, object_id)] = 0
+        if issubclass(model, VoteTallyMixin):
+            rows = model.admin_manager.filter(pk__in=ids).values_list('pk', 'vote_score')
+        else:
+            rows = [(row['object_id'], row['score']) for row in
+                    UserVote.objects.filter(content_type=content_type, object_id__in=ids
+                                            ).values('object_id').annotate(score=Sum('vote'))]
+        for object_id, score in rows:
+            scores[(content_type, object_id)] = score
+    return scores
+
+def _write_votes(new_votes, changed_votes, now):
+    """Insert new vote rows and flip changed ones, if none of them changed since they were read.
+    
+    Returns False, having written nothing, if a row was already inserted or no longer holds the
+    opposite vote.
+    """
+    sid = transaction.savepoint()
+    try:
+        for vote, ids in changed_votes.items():
+            if ids and UserVote.objects.filter(pk__in=ids, vote=-vote).update(vote=vote, modified_at=now) != len(ids):
+                transaction.savepoint_rollback(sid)
+                return False
+        if new_votes:
+            qn = connection.ops.quote_name
+            cursor = connection.cursor()
+            cursor.executemany('INSERT INTO %s (content_type_id, object_id, user_id, vote, created_at, modified_at) '
+                               'VALUES (%%s, %%s, %%s, %%s, %%s, %%s)' % qn(UserVote._meta.db_table), new_votes)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+def prefetch_vote_state(objects, user=None):
+    """Load the vote totals and, if user is given, the user's vote for a list of VoteMixin instances.
+    
+    Costs at most one grouped UserVote query per model for the totals (none for VoteTallyMixin
+    models or instances already annotated by by_votes()) and one for the user's votes.  The values
+    are stored on the instances, so voteValue(), voteUpCount(), voteDownCount() and userVote(user)
+    won't query again.  Returns the instances as a list.
+    """
+    objects = list(objects)
+    grouped = {}
+    for obj in objects:
+        if isinstance(obj, VoteMixin):
+            grouped.setdefault(obj.__class__, {}).setdefault(obj.pk, []).append(obj)
+    
+    for model, instances in grouped.items():
+        ct = ContentType.objects.get_for_model(model)
+        missing = []
+        for object_id, objs in instances.items():
+            for obj in objs:
+                if isinstance(obj, VoteTallyMixin):
+                    continue
+                if hasattr(obj, 'total_votes') and hasattr(obj, 'vote_score'):
+                    obj.voteupcount = (obj.total_votes + obj.vote_score) / 2
+                    obj.votedowncount = (obj.total_votes - obj.vote_score) / 2
+                    obj.votevalue = obj.vote_score
+                else:
+                    obj.voteupcount = obj.votedowncount = obj.votevalue = 0
+                    missing.append(object_id)
+        if missing:
+            rows = UserVote.objects.filter(content_type=ct, object_id__in=missing
+                                           ).values('object_id', 'vote').annotate(count=Count('id'))
+            for row in rows:
+                for obj in instances.get(row['object_id'], []):
+                    if row['vote'] == 1:
+                        obj.voteupcount = row['count']
+                    elif row['vote'] == -1:
+                        obj.votedowncount = row['count']
+                    obj.votevalue = obj.voteupcount - obj.votedowncount
+        
+        if user is not None and user.is_authenticated():
+            for objs in instances.values():
+                for obj in objs:
+                    obj.uservote = None
+                    obj.uservote_user = user.pk
+            for uservote in UserVote.objects.filter(content_type=ct, object_id__in=instances.keys(), user=user):
+                for obj in instances.get(uservote.object_id, []):
+                    obj.uservote = uservote
+    return objects
+
+@transaction.commit_on_success
+def rebuild_vote_tallies(model):
+    """Recompute the denormalized vote totals of every instance of a VoteTallyMixin model from UserVote."""
+    totals = {}
+    rows = UserVote.objects.filter(content_type=ContentType.objects.get_for_model(model)
+                                   ).values('object_id', 'vote').annotate(count=Count('id'))
+    for row in rows:
+        up, down = totals.get(row['object_id'], (0, 0))
+        if row['vote'] == 1:
+            up = row['count']
+        elif row['vote'] == -1:
+            down = row['count']
+        totals[row['object_id']] = (up, down)
+    
+    # Group instances sharing the same totals so each distinct tally costs one UPDATE.
+    grouped = {}
+    for object_id, tally in totals.items():
+        grouped.setdefault(tally, []).append(object_id)
+    model.admin_manager.all().update(vote_up_count=0, vote_down_count=0, vote_score=0)
+    for (up, down), ids in grouped.items():
+        model.admin_manager.filter(pk__in=ids).update(vote_up_count=up, vote_down_count=down, vote_score=up - down)
+
+def uservote_deleted(sender, instance, **kwargs):
+    """Keep denormalized vote state in sync when a UserVote row is removed."""
+    model = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+    if model is not None:
+        record_vote_change(model, instance.object_id, instance.vote, None)
+models.signals.post_delete.connect(uservote_deleted, sender=UserVote)
+
 class Comment(UserMixin, DateMixin, VoteMixin):
     """Contains a single users comment for any model that extends CommentMixin.""" 
     comment = models.TextField()
@@ -350,51 +1061,71 @@ class CommentMixin(models.Model):
         abstract = True
 
 class AutosuggestMixin(models.Model):
-    """Allow model to be searched using autosuggest. Change autosuggest_field from default of 'title' if need be."""
+    """Allow model to be searched using autosuggest. Change autosuggest_field from default of 'title' if need be.
+    
+    autosuggest_ordering may be set to a tuple of order_by() arguments used to rank results (see
+    mixins.search).  Setting autosuggest_url_fields to the fields get_absolute_url() needs (which
+    may be ()) makes views.autosuggest load only those, the id and the autosuggest field.
+    """
     autosuggest_field = 'title'
+    autosuggest_url_fields = None
     
     class Meta:
         abstract = True
 
-try:
-    import twitter
-    class TwitterMixin(models.Model):
-        """Send a tweet whenever the implementer decides.
-        
-        Requires python wrapper for Twitter API: http://code.google.com/p/python-twitter/
-        
-        Extending model must implement method twitter_message which takes no params and returns
-        a 140 character string to tweet.  It doesn't matter what's in it, which is why no implementation
-        is provided.
-        
-        Settings to be placed in settings.py:
-            TWEETING: if True, tweets will be sent
-            TWITTER_USERNAME
-            TWITTER_PASSWORD
-        """
+class AutosuggestEntry(models.Model):
+    """Normalized autosuggest term of an AutosuggestMixin instance, used by mixins.search.IndexBackend."""
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField(db_index=True)
+    term = models.CharField(max_length=search.TERM_LENGTH, db_index=True)
+    is_full = models.BooleanField(default=False)
+    
+    def __unicode__(self):
+        return self.term
+
+def autosuggest_saved(sender, instance, **kwargs):
+    """Keep the autosuggest index current when an AutosuggestMixin instance is saved."""
+    if isinstance(instance, AutosuggestMixin):
+        search.get_backend().update(instance)
+models.signals.post_save.connect(autosuggest_saved)
+
+def autosuggest_deleted(sender, instance, **kwargs):
+    """Remove a deleted AutosuggestMixin instance from the autosuggest index."""
+    if isinstance(instance, AutosuggestMixin):
+        search.get_backend().remove(instance)
+models.signals.post_delete.connect(autosuggest_deleted)
+
+class TwitterMixin(models.Model):
+    """Send a tweet whenever the implementer decides.
+    
+    Extending model must implement method twitter_message which takes no params and returns
+    a 140 character string to tweet.  It doesn't matter what's in it, which is why no implementation
+    is provided.
+    
+    tweet() only queues the message; the send_tweets command posts it.  See mixins.tweeting for
+    the settings to be placed in settings.py.
+    """
+    
+    class Meta:
+        abstract = True
         
-        class Meta:
-            abstract = True
-            
-        def tweet(self):
-            if not settings.TWEETING:
-                return
-            username = settings.TWITTER_USERNAME
-            password = settings.TWITTER_PASSWORD
-            message = self.twitter_message()
-            api = twitter.Api(username, password)
-            try:
-                api.PostUpdate(message)
-            except ValueError:
-                pass
-except ImportError:
-    class TwitterMixin(models.Model):
-        pass
-
-class ImageThumbEnum:
-    """Enum to handle thumb creation behavior."""
-    NORMAL = 0
-    FIT = 1
+    def tweet(self):
+        if not settings.TWEETING:
+            return
+        tweeting.queue(self.twitter_message())
+
+class QueuedTweet(models.Model):
+    """Message queued by TwitterMixin.tweet, sent by mixins.tweeting.send."""
+    message = models.TextField()
+    digest = models.CharField(max_length=40, unique=True, null=True, blank=True) # None once sent or failed
+    attempts = models.PositiveSmallIntegerField(default=0)
+    failed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __unicode__(self):
+        return self.message
 
 IMAGE_STYLE_CHOICES = (
     (ImageThumbEnum.NORMAL, _("Don't crop to fit")),
@@ -404,25 +1135,40 @@ class ImageMixin(models.Model):
     """Allows an image to be attached to a model instance.
     
     Creating thumbnails or resizing images requires PIL: http://www.pythonware.com/products/pil/
+    
+    Image processing triggered by save() and thumbnail() runs on the executor configured in
+    mixins.thumbnails.  While a thumbnail is being generated, thumbnail() returns the model's
+    image_thumb_placeholder url if set, or the original image's url.
+    
+    Besides image_thumb_resolution/image_thumb_type, a model may declare image_thumb_variants,
+    a tuple of ((w,h), type) pairs; all of them are generated from a single decode of the image
+    when it changes.  Use the regenerate_thumbnails command to (re)build them for existing rows.
+    
+    Thumbnail encoding is controlled by these optional model attributes:
+        image_thumb_format: 'JPEG', 'PNG' or 'WEBP' (default: the source image's format)
+        image_thumb_formats: further formats every thumbnail is also written in, e.g. ('WEBP',),
+            served through thumbnail_sources() as <picture> <source> elements
+        image_thumb_quality: JPEG/WebP quality (default: PIL's)
+        image_thumb_progressive: write progressive JPEGs (default False)
+        image_thumb_optimize: optimize JPEG/PNG encoder settings (default False)
+        image_thumb_strip_exif: drop EXIF data from thumbnails (default True)
+    WebP output requires a PIL built with WebP support.
     """
     image = models.ImageField(upload_to=get_image_path, null=True, blank=True)
     
     class Meta:
         abstract = True
+    
+    def __init__(self, *args, **kwargs):
+        super(ImageMixin, self).__init__(*args, **kwargs)
+        # Read from __dict__ so a deferred image isn't loaded; new_image() queries for it instead.
+        if 'image' in self.__dict__:
+            image = self.__dict__['image']
+            self._imageName = getattr(image, 'name', image) or None
         
     def resize_image(self, resolution):
-        try:
-            from PIL import Image
-            """If image_max_resolution (w,h) is specified on model, shrink down image to be less than that resolution.""" 
-            i_filename = self.image.path
-            if os.path.isfile(i_filename):
-                image = Image.open(i_filename)
-                if image.mode not in ('L', 'RGB'):
-                    image = image.convert('RGB')
-                image.thumbnail(resolution, Image.ANTIALIAS)
-                image.save(i_filename)
-        except ImportError:
-            pass
+        """If image_max_resolution (w,h) is specified on model, shrink down image to be less than that resolution.""" 
+        thumbnails.render_resized(self.image.storage, self.image.name, resolution)
             
     def create_thumbnail(self, resolution, type):
         """If image_thumb_resolution (w,h) is specified on model, will create a thumbnail with that size.
@@ -431,69 +1177,112 @@ class ImageMixin(models.Model):
         is maintained by taking slices from the edges so thumb won't contain whole image (but will be
         semi-centered).
         """
-        try:
-            from PIL import Image
-            i_filename = self.image.path
-            t_filename = "%s/tn_%sx%s_%s_%s" % (os.path.dirname(i_filename), resolution[0], resolution[1], type, os.path.basename(i_filename))
-            if os.path.isfile(i_filename) and not os.path.isfile(t_filename):
-                image = Image.open(i_filename)
-                if image.mode not in ('L', 'RGB'):
-                    image = image.convert('RGB')
-                if type == ImageThumbEnum.FIT:
-                    if (float(image.size[0]) / float(image.size[1])) > (float(resolution[0]) / float(resolution[1])):
-                        THUMBNAIL_SIZE = (float("infinity"), resolution[1])
-                    else:
-                        THUMBNAIL_SIZE = (resolution[0], float("infinity"))
-                    image.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
-                    x_left = (image.size[0] - resolution[0]) / 2
-                    y_top = (image.size[1] - resolution[1]) / 2
-                    region = image.crop((x_left, y_top, x_left + resolution[0], y_top + resolution[1]))
-                else:
-                    image.thumbnail(resolution, Image.ANTIALIAS)
-                    region = image
-                region.save(t_filename)
-        except ImportError:
-            pass
-    
-    def thumbnail(self, resolution=None, type=ImageThumbEnum.NORMAL):
-        """Return full path to thumbnail for model, or creates it if it doesn't exist."""
+        name = self.image.name
+        t_name = thumbnails.thumbnail_name(name, resolution, type, getattr(self, 'image_thumb_format', None))
+        thumbnails.render_thumbnail(self.image.storage, name, t_name, resolution, type, self.thumb_options())
+    
+    def thumb_variants(self):
+        """Return the (resolution, type) pairs of every thumbnail declared on the model."""
+        variants = []
+        if hasattr(self, 'image_thumb_resolution'):
+            variants.append((self.image_thumb_resolution, getattr(self, 'image_thumb_type', ImageThumbEnum.NORMAL)))
+        for variant in getattr(self, 'image_thumb_variants', ()):
+            if variant not in variants:
+                variants.append(variant)
+        return variants
+    
+    def thumb_formats(self):
+        """Return the formats thumbnails are written in, image_thumb_format (None for the source format) last."""
+        formats = list(getattr(self, 'image_thumb_formats', ()))
+        format = getattr(self, 'image_thumb_format', None)
+        if format in formats:
+            formats.remove(format)
+        formats.append(format)
+        return formats
+    
+    def thumb_options(self):
+        """Return the encoder options thumbnails are written with."""
+        return {'quality': getattr(self, 'image_thumb_quality', None),
+                'progressive': getattr(self, 'image_thumb_progressive', False),
+                'optimize': getattr(self, 'image_thumb_optimize', False),
+                'strip_exif': getattr(self, 'image_thumb_strip_exif', True)}
+    
+    def thumb_jobs(self):
+        """Return (t_name, resolution, type) for every declared thumbnail in every format."""
+        name = self.image.name
+        return [(thumbnails.thumbnail_name(name, resolution, type, format), resolution, type)
+                for resolution, type in self.thumb_variants() for format in self.thumb_formats()]
+    
+    def create_thumbnails(self, force=False):
+        """Create every declared thumbnail from a single decode of the image. Existing ones are kept unless force is True."""
+        thumbnails.process_image(self.image.storage, self.image.name, self.thumb_jobs(), force=force, options=self.thumb_options())
+    
+    def thumbnail(self, resolution=None, type=ImageThumbEnum.NORMAL, format=None):
+        """Return full path to thumbnail for model, or queues its creation if it doesn't exist.
+        
+        Thumbnails recorded in the thumbnail registry are returned without touching storage.
+        format defaults to image_thumb_format.
+        """
         if resolution is None and hasattr(self, 'image_thumb_resolution'):
             resolution = self.image_thumb_resolution
+        if format is None:
+            format = getattr(self, 'image_thumb_format', None)
         if self.image and resolution is not None:
-            i_filename = self.image.path
-            t_filename = "%s/tn_%sx%s_%s_%s" % (os.path.dirname(i_filename), resolution[0], resolution[1], type, os.path.basename(i_filename))
-            if not os.path.isfile(t_filename):
-                self.create_thumbnail(resolution, type)
-            if not os.path.isfile(t_filename):
-                return None
-            else:
-                return '%s/%s' % (os.path.dirname(self.image.url), os.path.basename(t_filename))
+            storage, name = self.image.storage, self.image.name
+            t_name = thumbnails.thumbnail_name(name, resolution, type, format)
+            if thumbnails.is_registered(name, t_name):
+                return storage.url(t_name)
+            if not storage.exists(t_name):
+                thumbnails.enqueue(t_name, thumbnails.render_thumbnail, storage, name, t_name, resolution, type,
+                                   self.thumb_options())
+            if storage.exists(t_name):
+                thumbnails.register(name, t_name)
+                return storage.url(t_name)
+            if thumbnails.is_pending(t_name):
+                return getattr(self, 'image_thumb_placeholder', None) or self.image.url
         return None
     
+    def thumbnail_sources(self, resolution=None, type=ImageThumbEnum.NORMAL):
+        """Return (mimetype, url) for each format the thumbnail is available in, in thumb_formats() order.
+        
+        Formats still being generated are left out, so the list can be rendered as <source> elements
+        of a <picture> whose <img> uses thumbnail().
+        """
+        if resolution is None and hasattr(self, 'image_thumb_resolution'):
+            resolution = self.image_thumb_resolution
+        sources = []
+        if self.image and resolution is not None:
+            name = self.image.name
+            for format in self.thumb_formats():
+                url = self.thumbnail(resolution, type, format)
+                t_name = thumbnails.thumbnail_name(name, resolution, type, format)
+                if url is not None and thumbnails.is_registered(name, t_name):
+                    sources.append((thumbnails.mimetype(t_name), url))
+        return sources
+    
     def new_image(self):
-        has_changed = False
+        """Return True if the image differs from the one last loaded from or saved to the database."""
         if not self.id:
-            has_changed = True
-        else:
+            return True
+        if self._state.db is None or not hasattr(self, '_imageName'):
+            # Built by hand or with the image deferred: the stored name has to be read.
             try:
-                old = self.__class__.objects.get(pk=self.id)
-                if not old.image or old.image.path != self.image.path:
-                    has_changed = True
-            except self.__class__.DoesNotExist:
-                has_changed = True
-        return has_changed
+                old = self.__class__._base_manager.filter(pk=self.id).values_list('image', flat=True)[0]
+            except IndexError:
+                return True
+            return not old or old != self.image.name
+        return not self._imageName or self._imageName != self.image.name
     
     def save(self):
         has_changed = self.image and self.new_image()
         super(ImageMixin, self).save()
+        self._imageName = self.image and self.image.name or None
         if self.image and has_changed:
-            if hasattr(self, 'image_thumb_resolution'):
-                type = ImageThumbEnum.NORMAL
-                if hasattr(self, 'image_thumb_type'):
-                    type = self.image_thumb_type
-                self.create_thumbnail(self.image_thumb_resolution, type)
-            if hasattr(self, 'image_max_resolution'):
-                self.resize_image(self.image_max_resolution)
+            name = self.image.name
+            jobs = self.thumb_jobs()
+            if jobs or hasattr(self, 'image_max_resolution'):
+                thumbnails.enqueue_image(self.image.storage, name, jobs, getattr(self, 'image_max_resolution', None),
+                                         self.thumb_options())
 
 class DomainMixin(models.Model):
     domain = models.CharField(max_length=40, null=True, blank=True)
@@ -502,12 +1291,26 @@ class DomainMixin(models.Model):
     class Meta:
         abstract=True
     
+    def __init__(self, *args, **kwargs):
+        super(DomainMixin, self).__init__(*args, **kwargs)
+        # Loaded values, so DomainMiddleware's cached owner lookups can be cleared after a change.
+        self._domainSource = (self.__dict__.get('domain'), self.__dict__.get('subdomain'))
+    
     def get_domain(self, force_subdomain=False):
         if self.domain and not force_subdomain:
             return 'http://%s' % self.domain
         else:
             return 'http://%s.%s' % (self.subdomain, Site.objects.get_current().domain)
 
+def domain_owner_changed(sender, instance, **kwargs):
+    """Clear DomainMiddleware's cached owner lookups of a saved or deleted DomainMixin instance."""
+    if isinstance(instance, DomainMixin):
+        middleware.forget_owner(instance)
+        if kwargs.get('created') is not None:
+            instance._domainSource = (instance.domain, instance.subdomain)
+models.signals.post_save.connect(domain_owner_changed)
+models.signals.post_delete.connect(domain_owner_changed)
+
 class EmailMixin(models.Model):
     email = models.CharField(max_length=320, null=True, blank=True)
     
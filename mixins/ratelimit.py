@@ -0,0 +1,22 @@
+"""Rate limiting shared by the batch workers (mixins.geocoding.drain, mixins.tweeting.send)."""
+import threading
+import time
+
+class RateLimiter(object):
+    """Spaces calls to wait() at least 1/rate seconds apart, across threads."""
+
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate or 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
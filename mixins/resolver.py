@@ -0,0 +1,61 @@
+"""Resolves the app__model strings posted to the autosuggest and vote views.
+
+Only models extending AutosuggestMixin may be autosuggested and only models extending VoteMixin
+may be voted on, so any other string is rejected without touching the database.  Resolutions
+are memoized for the life of the process.  warm() resolves every allowed model; it runs once
+when the process handles its first request, so requests never wait on a ContentType lookup.
+(Models aren't all loaded yet when this module is imported, so it can't run any earlier.)
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.signals import request_started
+from django.db.models import get_models
+import traceback
+
+AUTOSUGGEST = 'autosuggest'
+VOTE = 'vote'
+
+_allowed = None
+_resolved = {}
+
+def allowed_models():
+    """Return the whitelist of models as {purpose: {app__model: model class}}."""
+    global _allowed
+    if _allowed is None:
+        from mixins.models import AutosuggestMixin, VoteMixin
+        allowed = {AUTOSUGGEST: {}, VOTE: {}}
+        for model in get_models():
+            key = '%s__%s' % (model._meta.app_label, model._meta.object_name.lower())
+            if issubclass(model, AutosuggestMixin):
+                allowed[AUTOSUGGEST][key] = model
+            if issubclass(model, VoteMixin):
+                allowed[VOTE][key] = model
+        _allowed = allowed
+    return _allowed
+
+def resolve(contenttype, purpose):
+    """Return the (ContentType, model class) pair for an app__model string allowed for purpose.
+    
+    Raises ContentType.DoesNotExist if the string doesn't name a model allowed for purpose.
+    """
+    try:
+        model = allowed_models()[purpose][contenttype]
+    except KeyError:
+        raise ContentType.DoesNotExist('%r is not available for %s.' % (contenttype, purpose))
+    if contenttype not in _resolved:
+        _resolved[contenttype] = (ContentType.objects.get_for_model(model), model)
+    return _resolved[contenttype]
+
+def warm():
+    """Resolve every whitelisted model up front."""
+    for purpose, models in allowed_models().items():
+        for contenttype in models:
+            resolve(contenttype, purpose)
+
+def warm_on_first_request(sender, **kwargs):
+    request_started.disconnect(warm_on_first_request)
+    try:
+        warm()
+    except Exception:
+        # Models are still resolved on demand, so a failed warm-up must not fail the request.
+        traceback.print_exc()
+request_started.connect(warm_on_first_request)
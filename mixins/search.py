@@ -0,0 +1,133 @@
+"""Pluggable search backends used by views.autosuggest.
+
+Settings to be placed in settings.py:
+    MIXINS_AUTOSUGGEST_BACKEND: dotted path to the backend class (default 'mixins.search.ModelBackend')
+
+ModelBackend filters the model's table with icontains/istartswith.  IndexBackend answers from
+AutosuggestEntry rows holding the normalized autosuggest_field value of every instance plus each
+word-start suffix of it, so matching the beginning of the value or of any word in it becomes an
+indexed prefix lookup.  The index is maintained from post_save/post_delete; run the
+rebuild_autosuggest_index command to fill it for existing rows.
+
+Both backends rank results by the model's autosuggest_ordering (e.g. ('-vote_score',)), falling
+back to alphabetical order, so views.autosuggest can page through them with LIMIT/OFFSET.
+"""
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.utils.importlib import import_module
+import re
+import unicodedata
+
+TERM_LENGTH = 100
+
+_backend = None
+
+def get_backend():
+    """Return the configured autosuggest backend instance."""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'MIXINS_AUTOSUGGEST_BACKEND', 'mixins.search.ModelBackend')
+        module, name = path.rsplit('.', 1)
+        _backend = getattr(import_module(module), name)()
+    return _backend
+
+def normalize(value):
+    """Lowercase value, strip accents and punctuation, and collapse whitespace."""
+    value = unicodedata.normalize('NFKD', unicode(value)).encode('ascii', 'ignore').lower()
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', value).split())
+
+def index_terms(value):
+    """Return the (term, is_full) pairs indexed for value: the whole value and every word-start suffix."""
+    words = normalize(value).split()
+    return [(' '.join(words[i:])[:TERM_LENGTH], i == 0) for i in range(len(words))]
+
+def scoped(objects, user):
+    """Limit objects to global/user instances where the model supports it."""
+    try:
+        return objects.globals(user)
+    except AttributeError:
+        return objects
+
+def ranked(objects, model, field):
+    """Order objects by the model's autosuggest_ordering, or alphabetically by field."""
+    ordering = getattr(model, 'autosuggest_ordering', None)
+    if not ordering:
+        if field in [f.name for f in model._meta.fields]:
+            ordering = (field, 'pk')
+        else:
+            ordering = ('pk',)
+    return objects.order_by(*ordering)
+
+class ModelBackend(object):
+    """Search the model's own table.  Used as the fallback by other backends."""
+
+    def search(self, model, field, usertext, requirebeginning=False, filters=None, user=None):
+        """Return the instances of model whose field matches usertext, further filtered by filters."""
+        kwargs = dict(filters or {})
+        if requirebeginning:
+            kwargs[str(field + '__istartswith')] = usertext
+        else:
+            kwargs[str(field + '__icontains')] = usertext
+        return ranked(scoped(model.objects.filter(**kwargs), user), model, field)
+
+    def update(self, instance):
+        """Called after an AutosuggestMixin instance is saved."""
+        pass
+
+    def remove(self, instance):
+        """Called after an AutosuggestMixin instance is deleted."""
+        pass
+
+class IndexBackend(ModelBackend):
+    """Search the normalized prefix index kept in AutosuggestEntry.
+
+    Non-prefix (icontains) queries match the beginning of any word instead of any substring.
+    Queries on a field other than the model's autosuggest_field fall back to ModelBackend.
+    """
+
+    def search(self, model, field, usertext, requirebeginning=False, filters=None, user=None):
+        from mixins.models import AutosuggestEntry
+        term = normalize(usertext)[:TERM_LENGTH]
+        if field != model.autosuggest_field or not term:
+            return super(IndexBackend, self).search(model, field, usertext, requirebeginning, filters, user)
+        entries = AutosuggestEntry.objects.filter(content_type=ContentType.objects.get_for_model(model),
+                                                  term__startswith=term)
+        if requirebeginning:
+            entries = entries.filter(is_full=True)
+        objects = model.objects.filter(pk__in=entries.values('object_id'), **(filters or {}))
+        return ranked(scoped(objects, user), model, field)
+
+    def update(self, instance):
+        from mixins.models import AutosuggestEntry
+        ct = ContentType.objects.get_for_model(instance)
+        terms = index_terms(getattr(instance, instance.autosuggest_field) or '')
+        entries = AutosuggestEntry.objects.filter(content_type=ct, object_id=instance.pk)
+        if sorted(entries.values_list('term', 'is_full')) == sorted(terms):
+            return
+        entries.delete()
+        for term, is_full in terms:
+            AutosuggestEntry.objects.create(content_type=ct, object_id=instance.pk, term=term, is_full=is_full)
+
+    def remove(self, instance):
+        from mixins.models import AutosuggestEntry
+        AutosuggestEntry.objects.filter(content_type=ContentType.objects.get_for_model(instance),
+                                        object_id=instance.pk).delete()
+
+@transaction.commit_on_success
+def rebuild(model, batch_size=1000):
+    """Replace the AutosuggestEntry rows of an AutosuggestMixin model with freshly computed ones."""
+    from mixins.models import AutosuggestEntry
+    ct = ContentType.objects.get_for_model(model)
+    AutosuggestEntry.objects.filter(content_type=ct).delete()
+    sql = 'INSERT INTO %s (content_type_id, object_id, term, is_full) VALUES (%%s, %%s, %%s, %%s)' % (
+        connection.ops.quote_name(AutosuggestEntry._meta.db_table))
+    cursor = connection.cursor()
+    rows = []
+    for pk, value in model.objects.values_list('pk', model.autosuggest_field).iterator():
+        rows.extend([(ct.id, pk, term, is_full) for term, is_full in index_terms(value or '')])
+        if len(rows) >= batch_size:
+            cursor.executemany(sql, rows)
+            rows = []
+    if rows:
+        cursor.executemany(sql, rows)
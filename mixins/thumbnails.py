@@ -0,0 +1,363 @@
+"""Image processing used by ImageMixin and the job queue that runs it outside the request thread.
+
+Settings to be placed in settings.py:
+    MIXINS_THUMBNAIL_EXECUTOR: 'sync' (default, work runs inline), 'thread' or 'process'
+    MIXINS_THUMBNAIL_WORKERS: number of worker threads or processes (default 2)
+    MIXINS_THUMBNAIL_REGISTRY_TIMEOUT: seconds the thumbnail registry is cached (default 30 days)
+
+Jobs are keyed on the files they write (the image itself when it's resized, and each thumbnail),
+so a request for an (image, resolution, type) whose thumbnail is already being written by any
+pending job is coalesced into that job rather than queued again.
+
+The thumbnails generated for each image are recorded, with their dimensions, in a registry kept
+in the cache, so ImageMixin.thumbnail() only has to check storage when the registry misses.
+Use a shared cache backend with the 'process' executor so workers' entries reach the site.
+
+All file access goes through the image field's Storage, so any storage backend works (its
+instances must be picklable to use the 'process' executor).  Files are written under a
+temporary name first and only then moved into place, so a half-written file is never found.
+Images are copied through disk-spooled buffers and JPEGs are decoded at the smallest scale that
+still covers the target.
+
+A thumbnail is encoded in the format its name's extension maps to in FORMAT_EXTENSIONS (see
+thumbnail_name()), or in the source format otherwise, using encoder options given as a dict:
+    quality: JPEG/WebP quality (default: PIL's)
+    progressive: write progressive JPEGs (default False)
+    optimize: optimize JPEG/PNG encoder settings (default False)
+    strip_exif: drop the source's EXIF data (default True)
+
+Creating thumbnails or resizing images requires PIL: http://www.pythonware.com/products/pil/
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.utils.encoding import smart_str
+import hashlib
+import mimetypes
+import os
+import posixpath
+import Queue
+import tempfile
+import threading
+import traceback
+import uuid
+
+# Images larger than this many bytes are buffered on disk rather than in memory.
+SPOOL_SIZE = 1024 * 1024
+
+class ImageThumbEnum:
+    """Enum to handle thumb creation behavior."""
+    NORMAL = 0
+    FIT = 1
+
+FORMAT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+}
+
+def thumbnail_name(name, resolution, type, format=None):
+    """Return the storage name of the thumbnail of the image stored as name.
+    
+    If format is given, the source extension is replaced by the format's.
+    """
+    basename = posixpath.basename(name)
+    if format is not None:
+        basename = posixpath.splitext(basename)[0] + FORMAT_EXTENSIONS[format]
+    return posixpath.join(posixpath.dirname(name), "tn_%sx%s_%s_%s" % (resolution[0], resolution[1], type, basename))
+
+def output_format(name, default):
+    """Return the PIL format a file named name is written in, or default if its extension isn't in FORMAT_EXTENSIONS."""
+    extension = posixpath.splitext(name)[1].lower()
+    for format, format_extension in FORMAT_EXTENSIONS.items():
+        if extension == format_extension:
+            return format
+    return default
+
+def mimetype(name):
+    return mimetypes.guess_type(name)[0]
+
+def _registry_key(name):
+    return 'mixins:thumbnails:%s' % hashlib.md5(smart_str(name)).hexdigest()
+
+def registered(name):
+    """Return {thumbnail basename: (width, height) or None if unknown} for the thumbnails of an image."""
+    return cache.get(_registry_key(name)) or {}
+
+def is_registered(name, t_name):
+    return posixpath.basename(t_name) in registered(name)
+
+def register(name, t_name, size=None):
+    """Record that the thumbnail t_name of the image stored as name exists."""
+    variants = registered(name)
+    basename = posixpath.basename(t_name)
+    if basename not in variants or (size is not None and variants[basename] != size):
+        variants[basename] = size
+        cache.set(_registry_key(name), variants,
+                  getattr(settings, 'MIXINS_THUMBNAIL_REGISTRY_TIMEOUT', 60 * 60 * 24 * 30))
+
+def open_image(storage, name, size=None):
+    """Decode a stored image, copying it through a disk-spooled buffer so it may come from any storage.
+    
+    If size is given, decoders that can (JPEG) scale down while loading to no less than size.
+    Returns (image, format, size of the stored image before any scaling).
+    """
+    from PIL import Image
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    source = storage.open(name, 'rb')
+    try:
+        for chunk in source.chunks():
+            buffer.write(chunk)
+    finally:
+        source.close()
+    buffer.seek(0)
+    image = Image.open(buffer)
+    format = image.format
+    original_size = image.size
+    if size is not None:
+        image.draft(image.mode, size)
+    image.load()
+    buffer.close()
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+    return image, format, original_size
+
+def encoder_arguments(image, format, options=None):
+    """Return the keyword arguments Image.save() takes to encode image as format with the given encoder options."""
+    options = options or {}
+    kwargs = {}
+    if format in ('JPEG', 'WEBP') and options.get('quality') is not None:
+        kwargs['quality'] = options['quality']
+    if format in ('JPEG', 'PNG') and options.get('optimize'):
+        kwargs['optimize'] = True
+    if format == 'JPEG' and options.get('progressive'):
+        kwargs['progressive'] = True
+    if format in ('JPEG', 'WEBP') and not options.get('strip_exif', True) and image.info.get('exif'):
+        kwargs['exif'] = image.info['exif']
+    return kwargs
+
+def save_image(image, storage, name, format, options=None):
+    """Encode image through a disk-spooled buffer and store it as name, replacing any existing file.
+    
+    The file is written under a temporary name in the same directory, then moved into place: renamed
+    on storages with local paths, copied on others (which publish each upload whole).  On those,
+    an existing file is only deleted once the new one is stored, and IOError is raised if the
+    storage won't store it as name.
+    """
+    format = format or 'JPEG'
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    image.save(buffer, format, **encoder_arguments(image, format, options))
+    content = File(buffer)
+    content.size = buffer.tell()
+    temporary = storage.save(posixpath.join(posixpath.dirname(name), 'tmp_%s_%s' % (uuid.uuid4().hex, posixpath.basename(name))), content)
+    try:
+        try:
+            os.rename(storage.path(temporary), storage.path(name))
+        except NotImplementedError:
+            saved = storage.save(name, content)
+            if saved != name:
+                # name was taken by the file being replaced, which can go now the new one is stored.
+                storage.delete(name)
+                replaced = storage.save(name, content)
+                storage.delete(saved)
+                if replaced != name:
+                    storage.delete(replaced)
+                    raise IOError('Storage saved %s as %s.' % (name, replaced))
+    finally:
+        buffer.close()
+        if storage.exists(temporary):
+            storage.delete(temporary)
+
+def scaled_size(size, resolution, type):
+    """Return the size an image of the given size is scaled to for a thumbnail, before any cropping.
+    
+    NORMAL thumbnails fit within resolution, FIT thumbnails cover it.  Images are never enlarged.
+    """
+    if type == ImageThumbEnum.FIT:
+        ratio = max(float(resolution[0]) / size[0], float(resolution[1]) / size[1])
+    else:
+        ratio = min(float(resolution[0]) / size[0], float(resolution[1]) / size[1])
+    if ratio >= 1:
+        return tuple(size)
+    scaled = [max(int(round(size[i] * ratio)), 1) for i in (0, 1)]
+    for i in (0, 1):
+        # Rounding mustn't leave a FIT thumbnail short of, or a NORMAL one over, the resolution.
+        if type == ImageThumbEnum.FIT:
+            scaled[i] = max(scaled[i], resolution[i])
+        else:
+            scaled[i] = min(scaled[i], resolution[i])
+    return tuple(scaled)
+
+def render_variants(image, format, storage, name, thumbnails, options=None):
+    """Store (t_name, resolution, type) thumbnails of an already decoded image.
+    
+    Thumbnails are produced largest first, each scaled down from the previous uncropped step
+    rather than from the full image.  If type is FIT, image will be fit to the exact resolution.
+    Aspect ratio is maintained by taking slices from the edges so thumb won't contain whole image
+    (but will be semi-centered).
+    """
+    from PIL import Image
+    steps = [(scaled_size(image.size, resolution, type), t_name, resolution, type) for t_name, resolution, type in thumbnails]
+    steps.sort(reverse=True)
+    source = image
+    for size, t_name, resolution, type in steps:
+        if size[0] > source.size[0] or size[1] > source.size[1]:
+            source = image
+        if size != source.size:
+            source = source.resize(size, Image.ANTIALIAS)
+        region = source
+        if type == ImageThumbEnum.FIT:
+            x_left = (size[0] - resolution[0]) / 2
+            y_top = (size[1] - resolution[1]) / 2
+            region = source.crop((x_left, y_top, x_left + resolution[0], y_top + resolution[1]))
+        save_image(region, storage, t_name, output_format(t_name, format), options)
+        register(name, t_name, region.size)
+
+def process_image(storage, name, thumbnails, max_resolution=None, force=False, options=None):
+    """Decode a stored image once, store its (t_name, resolution, type) thumbnails, then shrink it to max_resolution.
+    
+    Thumbnails that already exist are skipped unless force is True.  options are the thumbnails'
+    encoder options; the resized image keeps its format and PIL's default settings.
+    """
+    try:
+        from PIL import Image
+        if not storage.exists(name):
+            return
+        if not force:
+            thumbnails = [thumb for thumb in thumbnails if not storage.exists(thumb[0])]
+        sizes = [resolution for t_name, resolution, type in thumbnails]
+        if max_resolution is not None:
+            sizes.append(max_resolution)
+        if not sizes:
+            return
+        image, format, original_size = open_image(storage, name, (max([size[0] for size in sizes]), max([size[1] for size in sizes])))
+        render_variants(image, format, storage, name, thumbnails, options)
+        # The draft may already have scaled the image down to max_resolution, so test the stored size.
+        if max_resolution is not None and (original_size[0] > max_resolution[0] or original_size[1] > max_resolution[1]):
+            image.thumbnail(max_resolution, Image.ANTIALIAS)
+            save_image(image, storage, name, format)
+    except ImportError:
+        pass
+
+def render_thumbnail(storage, name, t_name, resolution, type, options=None):
+    """Store a thumbnail of the image stored as name as t_name, unless it already exists."""
+    process_image(storage, name, [(t_name, resolution, type)], options=options)
+
+def render_resized(storage, name, resolution):
+    """Shrink the image stored as name in place to fit within resolution."""
+    process_image(storage, name, [], resolution)
+
+def run_job(function, args):
+    """Run a job, printing rather than raising its errors so a worker never dies on a bad image."""
+    try:
+        function(*args)
+    except Exception:
+        traceback.print_exc()
+
+class SyncExecutor(object):
+    """Runs jobs inline, in the caller's thread."""
+
+    def submit(self, function, args, callback):
+        try:
+            run_job(function, args)
+        finally:
+            callback()
+
+class ThreadExecutor(object):
+    """Runs jobs on a pool of daemon threads."""
+
+    def __init__(self, workers):
+        self.queue = Queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+
+    def work(self):
+        while True:
+            function, args, callback = self.queue.get()
+            try:
+                run_job(function, args)
+            finally:
+                callback()
+
+    def submit(self, function, args, callback):
+        self.queue.put((function, args, callback))
+
+class ProcessExecutor(object):
+    """Runs jobs on a multiprocessing pool, so image decoding doesn't compete for the GIL."""
+
+    def __init__(self, workers):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(workers)
+
+    def submit(self, function, args, callback):
+        self.pool.apply_async(run_job, (function, args), callback=lambda result: callback())
+
+EXECUTORS = {
+    'sync': lambda workers: SyncExecutor(),
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+}
+
+_executor = None
+_pending = set()
+_lock = threading.Lock()
+
+def get_executor():
+    """Return the configured executor, creating it on first use."""
+    global _executor
+    _lock.acquire()
+    try:
+        if _executor is None:
+            name = getattr(settings, 'MIXINS_THUMBNAIL_EXECUTOR', 'sync')
+            _executor = EXECUTORS[name](getattr(settings, 'MIXINS_THUMBNAIL_WORKERS', 2))
+        return _executor
+    finally:
+        _lock.release()
+
+def is_pending(key):
+    return key in _pending
+
+def _finished(*keys):
+    _lock.acquire()
+    try:
+        _pending.difference_update(keys)
+    finally:
+        _lock.release()
+
+def enqueue(key, function, *args):
+    """Queue function(*args) unless a job with the same key is pending.  Returns True if it was queued."""
+    executor = get_executor()
+    _lock.acquire()
+    try:
+        if key in _pending:
+            return False
+        _pending.add(key)
+    finally:
+        _lock.release()
+    executor.submit(function, args, lambda: _finished(key))
+    return True
+
+def enqueue_image(storage, name, thumbnails, max_resolution=None, options=None):
+    """Queue process_image() for a stored image, keyed on the image and on each thumbnail it writes.
+    
+    Thumbnails, or the resize, that a pending job is already writing are left to that job.
+    Returns True if anything was queued.
+    """
+    executor = get_executor()
+    _lock.acquire()
+    try:
+        thumbnails = [thumb for thumb in thumbnails if thumb[0] not in _pending]
+        keys = [thumb[0] for thumb in thumbnails]
+        if max_resolution is not None and name not in _pending:
+            keys.append(name)
+        else:
+            max_resolution = None
+        if not keys:
+            return False
+        _pending.update(keys)
+    finally:
+        _lock.release()
+    executor.submit(process_image, (storage, name, thumbnails, max_resolution, False, options), lambda: _finished(*keys))
+    return True
@@ -0,0 +1,133 @@
+"""Tweet outbox used by TwitterMixin.
+
+Settings to be placed in settings.py:
+    TWEETING: if True, tweets will be queued and sent
+    TWITTER_USERNAME
+    TWITTER_PASSWORD
+    MIXINS_TWITTER_BACKEND: dotted path to the backend class (default 'mixins.tweeting.TwitterBackend')
+    MIXINS_TWITTER_RATE: most tweets per second sent by send() (default 1)
+    MIXINS_TWITTER_CLAIM_TIMEOUT: seconds after which a tweet claimed by a worker that never
+        finished it may be claimed again (default 600)
+
+TwitterMixin.tweet() only inserts a QueuedTweet row; the send_tweets command posts the queue
+through a single backend instance.  Each tweet is claimed with a conditional UPDATE before it's
+posted, so workers running at the same time never post the same tweet.  A message waiting to be
+sent isn't queued twice: the same text queued again is dropped until the first one was sent or
+has failed.  FakeBackend keeps sent messages in memory, for tests.
+
+TwitterBackend requires python wrapper for Twitter API: http://code.google.com/p/python-twitter/
+"""
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.encoding import smart_str
+from django.utils.importlib import import_module
+from mixins.ratelimit import RateLimiter
+import datetime
+import hashlib
+import time
+import traceback
+
+_backend = None
+
+def get_backend():
+    """Return the configured backend instance."""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'MIXINS_TWITTER_BACKEND', 'mixins.tweeting.TwitterBackend')
+        module, name = path.rsplit('.', 1)
+        _backend = getattr(import_module(module), name)()
+    return _backend
+
+class TwitterBackend(object):
+    """Post through one python-twitter client, created on first use."""
+
+    def __init__(self):
+        self.api = None
+
+    def post(self, message):
+        if self.api is None:
+            import twitter
+            self.api = twitter.Api(settings.TWITTER_USERNAME, settings.TWITTER_PASSWORD)
+        self.api.PostUpdate(message)
+
+class FakeBackend(object):
+    """Record posted messages in sent instead of posting them."""
+    sent = []
+
+    def post(self, message):
+        if len(message) > 140:
+            raise ValueError('Message is longer than 140 characters.')
+        self.sent.append(message)
+
+def message_digest(message):
+    return hashlib.sha1(smart_str(message)).hexdigest()
+
+def queue(message):
+    """Queue message to be sent by send().  Returns False if the same message is already waiting to be sent."""
+    from mixins.models import QueuedTweet
+    sid = transaction.savepoint()
+    try:
+        QueuedTweet.objects.create(message=message, digest=message_digest(message))
+        transaction.savepoint_commit(sid)
+        return True
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return False
+
+def _post(backend, limiter, message, retries):
+    """Post message, retrying failures with backoff.  Returns True once it's sent.
+    
+    ValueError means the message itself was rejected (e.g. too long), so it isn't retried.
+    """
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            backend.post(message)
+            return True
+        except ValueError:
+            traceback.print_exc()
+            return False
+        except Exception:
+            if attempt == retries:
+                traceback.print_exc()
+                return False
+            time.sleep(2 ** attempt)
+
+def send(batch_size=100, rate=None, retries=2, max_attempts=3):
+    """Post every unsent QueuedTweet, oldest first.  Returns (sent, failed).
+    
+    A tweet that failed in max_attempts runs is marked as failed and no longer tried.  Tweets
+    claimed by another worker are skipped.  Sent and failed tweets give up their digest, so the
+    same message can be queued again.
+    """
+    from mixins.models import QueuedTweet
+    if rate is None:
+        rate = getattr(settings, 'MIXINS_TWITTER_RATE', 1)
+    backend = get_backend()
+    limiter = RateLimiter(rate)
+    sent = failed = 0
+    last_id = 0
+    while True:
+        tweets = list(QueuedTweet.objects.filter(sent_at=None, failed=False, pk__gt=last_id).order_by('pk')[:batch_size])
+        if not tweets:
+            break
+        last_id = tweets[-1].pk
+        for tweet in tweets:
+            now = datetime.datetime.now()
+            stale = now - datetime.timedelta(seconds=getattr(settings, 'MIXINS_TWITTER_CLAIM_TIMEOUT', 600))
+            claimable = QueuedTweet.objects.filter(Q(claimed_at=None) | Q(claimed_at__lt=stale),
+                                                   pk=tweet.pk, sent_at=None, failed=False)
+            if not claimable.update(claimed_at=now):
+                continue
+            if _post(backend, limiter, tweet.message, retries):
+                QueuedTweet.objects.filter(pk=tweet.pk).update(sent_at=datetime.datetime.now(), digest=None)
+                sent += 1
+            else:
+                fields = {'attempts': tweet.attempts + 1, 'claimed_at': None,
+                          'failed': tweet.attempts + 1 >= max_attempts}
+                if fields['failed']:
+                    fields['digest'] = None
+                QueuedTweet.objects.filter(pk=tweet.pk).update(**fields)
+                failed += 1
+    return sent, failed
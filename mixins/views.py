@@ -1,8 +1,38 @@
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.http import HttpResponse
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified
 from django.template.defaultfilters import slugify
 from django.utils import simplejson
+from django.utils.cache import patch_cache_control
 from django.utils.html import escape
+from mixins import resolver, search
+import hashlib
+import re
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Older Django versions stream any HttpResponse given an iterator.
+    StreamingHttpResponse = HttpResponse
+
+def json_stream(rows, **extra):
+    """Yield a JSON object holding the extra keys and a "results" list, serializing rows one at a time."""
+    yield '{'
+    for key, value in extra.items():
+        yield '%s: %s, ' % (simplejson.dumps(key), simplejson.dumps(value))
+    yield '"results": ['
+    separator = ''
+    for row in rows:
+        yield separator + simplejson.dumps(row)
+        separator = ', '
+    yield ']}'
+
+def autosuggest_row(object, field):
+    """Build the JSON result returned by autosuggest for a single instance."""
+    return {'id': object.id, 'value': str(escape(getattr(object, field))), 'url': object.get_absolute_url()}
 
 def autosuggest(request):
     """Accepts a GET request (usually AJAX) and returns a JSON object containing a list of matching instances.
@@ -14,6 +44,10 @@ def autosuggest(request):
         requirebeginning: if True, user text will only be matched against the beginning of the word.
         user_only: limit results to those whose user field matches the current user.
         filter_<model_field>=<filter_value>: filter the results on the provided fields (can provide 0 or more).
+        limit: maximum number of results to return (default MIXINS_AUTOSUGGEST_LIMIT or 20, at most MIXINS_AUTOSUGGEST_MAX_LIMIT or 100).
+        offset: number of results to skip, for paging (default 0).
+        stream: if True, results are streamed as they're read from the database and aren't cached.
+            For staff users limit is then optional and unbounded, for exports and admin tools.
         
     Each result in return contains:
         id: id of model.
@@ -21,18 +55,30 @@ def autosuggest(request):
         url: absolute url for model (must implement get_absolute_url on model). 
         
     Will try first to only return global/user matching results, if that fails it'll return all matching.
+    
+    If the model sets autosuggest_url_fields, only those, the id and the field are loaded.  Responses are cached
+    per query and user for MIXINS_AUTOSUGGEST_CACHE_TIMEOUT seconds (default 30) and carry an ETag,
+    so repeated requests are served from the cache or answered with a 304.
     """
     results = {'results': []}
+    serialized = None
+    cache_key = None
     if request.GET.has_key('contenttype') and request.GET.has_key('usertext'):
         try:
-            app_label, model = request.GET['contenttype'].split('__')
-            ct = ContentType.objects.get(app_label=app_label, model=model)
+            ct, model_class = resolver.resolve(request.GET['contenttype'], resolver.AUTOSUGGEST)
             usertext = request.GET['usertext']
-            field = request.GET.get('field', ct.model_class().autosuggest_field)
-            if request.GET.has_key('requirebeginning') and request.GET['requirebeginning']:
-                kwargs = { str(field + '__istartswith'): str(usertext) }
+            field = request.GET.get('field', model_class.autosuggest_field)
+            requirebeginning = bool(request.GET.has_key('requirebeginning') and request.GET['requirebeginning'])
+            stream = bool(request.GET.get('stream'))
+            if stream and request.user.is_staff and not request.GET.get('limit'):
+                limit = None
+            elif stream and request.user.is_staff:
+                limit = max(0, int(request.GET['limit']))
             else:
-                kwargs = { str(field + '__icontains'): str(usertext) }
+                limit = max(0, min(int(request.GET.get('limit', getattr(settings, 'MIXINS_AUTOSUGGEST_LIMIT', 20))),
+                                   getattr(settings, 'MIXINS_AUTOSUGGEST_MAX_LIMIT', 100)))
+            offset = max(int(request.GET.get('offset', 0)), 0)
+            kwargs = {}
             if request.GET.has_key('user_only'):
                 kwargs['user'] = request.user
             for key, value in request.GET.iteritems():
@@ -41,17 +87,42 @@ def autosuggest(request):
                     if value == "None":
                         value = None
                     kwargs[key] = value
-            try:
-                objects = ct.model_class().objects.filter(**kwargs).globals(request.user)
-            except AttributeError:
-                objects = ct.model_class().objects.filter(**kwargs)
-            for object in objects:
-                result_row = {'id': object.id, 'value': str(escape(getattr(object, field))), 'url': object.get_absolute_url()}
-                results['results'].append(result_row)
-        except ContentType.DoesNotExist:
-            pass
-    serialized = simplejson.dumps(results)
-    return HttpResponse(serialized, mimetype="application/json")
+            objects = search.get_backend().search(model_class, field, usertext, requirebeginning, kwargs, request.user)
+            url_fields = model_class.autosuggest_url_fields
+            if url_fields is not None and field in [f.name for f in model_class._meta.fields]:
+                objects = objects.only(model_class._meta.pk.name, field, *url_fields)
+            
+            if stream:
+                if limit is None:
+                    objects = objects[offset:]
+                else:
+                    objects = objects[offset:offset + limit]
+                rows = (autosuggest_row(object, field) for object in objects.iterator())
+                return StreamingHttpResponse(json_stream(rows), content_type="application/json")
+            
+            scope = request.user.is_authenticated() and request.user.pk or None
+            filters = sorted([(key, value) for key, value in request.GET.iteritems() if key.find('filter_') == 0])
+            cache_key = 'mixins:autosuggest:%s' % hashlib.md5(repr((request.GET['contenttype'], usertext.lower(), field,
+                                                                    requirebeginning, request.GET.has_key('user_only'),
+                                                                    filters, scope, limit, offset))).hexdigest()
+            serialized = cache.get(cache_key)
+            if serialized is None:
+                for object in objects[offset:offset + limit]:
+                    results['results'].append(autosuggest_row(object, field))
+        except (ContentType.DoesNotExist, ValueError):
+            cache_key = None
+    if serialized is None:
+        serialized = simplejson.dumps(results)
+        if cache_key is not None:
+            cache.set(cache_key, serialized, getattr(settings, 'MIXINS_AUTOSUGGEST_CACHE_TIMEOUT', 30))
+    
+    etag = '"%s"' % hashlib.md5(serialized).hexdigest()
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        return HttpResponseNotModified()
+    response = HttpResponse(serialized, mimetype="application/json")
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'MIXINS_AUTOSUGGEST_CACHE_TIMEOUT', 30))
+    return response
 
 def vote(request):
     """Accepts a GET request (usually AJAX) containing a vote and returns a JSON status response.
@@ -71,11 +142,10 @@ def vote(request):
     error = 1
     if request.GET.has_key('contenttype') and request.GET.has_key('id') and request.GET.has_key('vote'):
         try:
-            app_label, model = request.GET['contenttype'].split('__')
-            ct = ContentType.objects.get(app_label=app_label, model=model)
+            ct, model_class = resolver.resolve(request.GET['contenttype'], resolver.VOTE)
             id = request.GET['id']
             v = request.GET['vote']
-            obj = ct.model_class().objects.filter(pk=id)
+            obj = model_class.objects.filter(pk=id)
             if obj:
                 obj = obj[0]
                 if request.user.is_authenticated():
@@ -94,17 +164,64 @@ def vote(request):
     serialized = simplejson.dumps(response)
     return HttpResponse(serialized, mimetype="application/json")
 
+def vote_batch(request):
+    """Accepts a POST (usually a client replaying queued votes) applying many votes at once and returns a JSON status response.
+    
+    POST keys (or a JSON request body holding the same list):
+        votes: JSON list of [contenttype, id, vote] entries. contenttype takes form of app__model,
+            vote is 1 for up-vote and -1 for down-vote (required).
+    
+    GET keys:
+        stream: if True, the results are streamed rather than serialized in one piece.
+    
+    Return:
+        error: 0 if successful, 1 if not.
+        results: list containing contenttype, id and value (net vote value) for each instance voted on.
+    """
+    from mixins.models import cast_votes
+    scores = {}
+    error = 1
+    if request.method == 'POST' and request.user.is_authenticated():
+        try:
+            if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+                entries = simplejson.loads(request.raw_post_data)
+            else:
+                entries = simplejson.loads(request.POST['votes'])
+            votes = []
+            for contenttype, id, v in entries:
+                try:
+                    ct, model_class = resolver.resolve(contenttype, resolver.VOTE)
+                    votes.append((ct, id, v))
+                except ContentType.DoesNotExist:
+                    pass
+            scores = cast_votes(request.user, votes)
+            error = 0
+        except (KeyError, TypeError, ValueError):
+            pass
+        except IntegrityError:
+            # cast_vote lost repeated races for a vote; the whole batch was rolled back.
+            pass
+    rows = ({'contenttype': '%s__%s' % (ct.app_label, ct.model), 'id': id, 'value': value}
+            for (ct, id), value in scores.iteritems())
+    if request.GET.get('stream'):
+        return StreamingHttpResponse(json_stream(rows, error=error), content_type="application/json")
+    response = {'error': error, 'results': list(rows)}
+    serialized = simplejson.dumps(response)
+    return HttpResponse(serialized, mimetype="application/json")
+
 def get_image_path(instance, filename):
     """Used by ImageMixin to set path to image based on specified path and filename."""
     return '%s/%s' % (instance.image_path, filename)
 
-def SlugifyUniquely(value, model, slugfield="slug"):
+def SlugifyUniquely(value, model, slugfield="slug", exclude=None):
     """Returns a slug on a name which is unique within a model's table
 
-    This code suffers a race condition between when a unique
-    slug is determined and when the object with that slug is saved.
-    It's also not exactly database friendly if there is a high
-    likelyhood of common slugs being attempted.
+    Every existing slug of the form base or base-N is read with a single query (soft-deleted
+    rows included, since they still hold their slug) and the first free suffix is picked in
+    Python.  A race remains between when a unique slug is determined and when the object with
+    that slug is saved; put a unique index on the slug column and SlugMixin will retry the save
+    with a fresh slug if it loses.  Pass the instance's pk as exclude so its own slug isn't
+    treated as a conflict.  A value that slugifies to nothing is slugged on the model's name.
 
     A good usage pattern for this code would be to add a custom save()
     method to a model with a slug field along the lines of:
@@ -120,12 +237,20 @@ def SlugifyUniquely(value, model, slugfield="slug"):
     Original pattern discussed at
     http://www.b-list.org/weblog/2006/11/02/django-tips-auto-populated-fields
     """
+    base = slugify(value) or model._meta.module_name
+    pattern = re.compile(r'^%s(?:-([2-9]|[1-9][0-9]+))?$' % re.escape(base))
+    existing = model._base_manager.filter(Q(**{str(slugfield): base}) |
+                                          Q(**{str(slugfield + '__startswith'): base + '-'}))
+    if exclude is not None:
+        existing = existing.exclude(pk=exclude)
+    taken = set()
+    for slug in existing.values_list(slugfield, flat=True):
+        match = pattern.match(slug)
+        if match:
+            taken.add(int(match.group(1) or 1))
     suffix = 1
-    potential = base = slugify(value)
-    while True:
-            if suffix > 1:
-                    potential = "-".join([base, str(suffix)])
-            if not model.objects.filter(**{slugfield: potential}).count():
-                    return potential
-            # we hit a conflicting slug, so bump the suffix & try again
-            suffix += 1
\ No newline at end of file
+    while suffix in taken:
+            suffix += 1
+    if suffix == 1:
+            return base
+    return "-".join([base, str(suffix)])
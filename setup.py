@@ -8,6 +8,6 @@ setup(
     author_email = 'adamldoyle@gmail.com',
     description = 'A collection of abstract classes to add a variety of functionality to Django models.',
     license = 'GNU General Public License',
-    packages = ['mixins'],
+    packages = ['mixins', 'mixins.management', 'mixins.management.commands'],
     requires = ['django', 'geopy', 'PIL', 'twitter'],
 )
\ No newline at end of file